@@ -28,26 +28,92 @@ Original file is located at
 
 
 
-# Check if GPU is enabled
-import tensorflow as tf
-
-# Helper function to download data and extract
+# Only the standard library is imported at module level. TensorFlow, Keras, NumPy,
+# matplotlib and PIL are imported inside the functions that need them, so importing
+# this module (or running a CLI subcommand such as prepare) stays fast
 import os
 from pathlib import Path
 
 
-import matplotlib.pyplot as plt
-import matplotlib.image as img
-import numpy as np
 from collections import defaultdict
 import collections
+import functools
+import json
+
+CLASSES_FILE = 'classes.txt'
 
-foods_sorted = open("classes.txt").readlines()
-print(foods_sorted)
+@functools.lru_cache()
+def load_classes(path=CLASSES_FILE):
+    with open(path) as txt:
+        return [food.strip() for food in txt.readlines() if food.strip()]
+
+# Class names in the order of the model outputs. Training labels follow the sorted folder names
+# (flow_from_directory, make_dataset), which differs from classes.txt: it lists cheesecake
+# before cheese_plate
+@functools.lru_cache()
+def model_classes(path=CLASSES_FILE):
+    return sorted(load_classes(path))
 
 # Helper method to split dataset into train and test folders
-from shutil import copy
-def prepare_data(filepath, src,dest):
+# Images can be copied, hardlinked, symlinked or reflinked (copy-on-write clone) on a thread pool.
+# Every finished class is recorded in <dest>/manifest.json with the size and sha1 of its files,
+# so a rerun skips completed classes without listing them, and verify=True checks the folder
+# against the manifest, reporting missing or corrupt files without touching the disk.
+# repair=True runs that check first and places the flagged files again
+import hashlib
+import shutil
+import fcntl
+from concurrent.futures import ThreadPoolExecutor
+
+FICLONE = 0x40049409
+MANIFEST = 'manifest.json'
+
+def file_sha1(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def reflink(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            # Filesystem without copy-on-write support, fall back to a plain copy
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+
+def place_file(src, dst, mode='copy'):
+    if mode == 'copy':
+        shutil.copyfile(src, dst)
+    elif mode == 'hardlink':
+        os.link(src, dst)
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    elif mode == 'reflink':
+        reflink(src, dst)
+    else:
+        raise ValueError("Unknown mode %r, use copy, hardlink, symlink or reflink" % mode)
+
+
+def read_manifest(dest):
+    path = os.path.join(dest, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, dest):
+    tmp = os.path.join(dest, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(dest, MANIFEST))
+
+
+def prepare_data(filepath, src, dest, mode='copy', workers=16, verify=False, repair=False):
     classes_images = defaultdict(list)
     with open(filepath, 'r') as txt:
         paths = [read.strip() for read in txt.readlines()]
@@ -55,17 +121,89 @@ def prepare_data(filepath, src,dest):
             food = p.split('/')
             classes_images[food[0]].append(food[1] + '.jpg')
 
-    for food in classes_images.keys():
-        print("\nCopying images into ",food)
-        if not os.path.exists(os.path.join(dest,food)):
-            os.makedirs(os.path.join(dest,food))
-        if not len(os.listdir(os.path.join(dest,food))) == 250:    
-            for i in classes_images[food]:
-                if not Path(os.path.join(dest,food,i)).is_file():
-                    copy(os.path.join(src,food,i), os.path.join(dest,food,i))
+    if verify:
+        return verify_data(classes_images, src, dest, workers)
+
+    os.makedirs(dest, exist_ok=True)
+    manifest = read_manifest(dest)
+
+    def place(food, i):
+        target = os.path.join(dest, food, i)
+        if not os.path.isfile(target):
+            # Place under a temporary name so an interrupted run never leaves a truncated image
+            part = target + '.part'
+            if os.path.lexists(part):
+                os.remove(part)
+            place_file(os.path.join(src, food, i), part, mode)
+            os.replace(part, target)
+        return i, [os.path.getsize(target), file_sha1(target)]
+
+    def replace(food, i):
+        target = os.path.join(dest, food, i)
+        if os.path.lexists(target):
+            os.remove(target)
+        return place(food, i)
+
+    if repair:
+        report = verify_data(classes_images, src, dest, workers)
+        damaged = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            flagged = [os.path.split(f) for f in report['missing'] + report['corrupt']]
+            for (food, _), (i, entry) in zip(flagged, pool.map(lambda f: replace(*f), flagged)):
+                expected = manifest.get(food, {}).get(i)
+                if expected is not None and entry != expected:
+                    # Still wrong after placing it again: the source is damaged too (with hardlink or
+                    # symlink the target is the source), so the manifest keeps the good entry
+                    damaged.append(os.path.join(food, i))
+                elif food in manifest:
+                    manifest[food][i] = entry
+        write_manifest(manifest, dest)
+        print("Repaired files:", len(flagged) - len(damaged))
+        if damaged:
+            raise RuntimeError("%d source images differ from the manifest and cannot be repaired: %s"
+                               % (len(damaged), ', '.join(damaged[:10])))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for food, images in classes_images.items():
+            if food in manifest and sorted(manifest[food]) == sorted(images):
+                continue
+            print("\nCopying images into ", food)
+            os.makedirs(os.path.join(dest, food), exist_ok=True)
+            manifest[food] = dict(pool.map(lambda i: place(food, i), images))
+            write_manifest(manifest, dest)
 
     print("Copying Done#")
     return Path(dest)
+
+
+# Dry run of prepare_data: nothing is written, returns {'missing': [...], 'corrupt': [...]}
+# Files are checked against the manifest, or against the source image for classes not in it
+def verify_data(classes_images, src, dest, workers=16):
+    manifest = read_manifest(dest)
+
+    def check(food, i):
+        target = os.path.join(dest, food, i)
+        if not os.path.isfile(target):
+            return 'missing'
+        expected = manifest.get(food, {}).get(i)
+        if expected is None:
+            source = os.path.join(src, food, i)
+            if not os.path.isfile(source):
+                return None
+            expected = [os.path.getsize(source), file_sha1(source)]
+        if os.path.getsize(target) != expected[0] or file_sha1(target) != expected[1]:
+            return 'corrupt'
+        return None
+
+    report = {'missing': [], 'corrupt': []}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for food, images in classes_images.items():
+            for i, status in zip(images, pool.map(lambda i: check(food, i), images)):
+                if status is not None:
+                    report[status].append(os.path.join(food, i))
+
+    print("Missing files:", len(report['missing']), "Corrupt files:", len(report['corrupt']))
+    return report
 """ DONE """
 # Prepare train dataset by copying images from food-101/images to food-101/train using the file train.txt
 # print("Creating train data...")
@@ -98,6 +236,7 @@ dest_test = 'dataset/test'
 # Helper function to select n random food classes
 import random
 def pick_n_random_classes(n):
+    foods_sorted = load_classes()
     food_list = []
     random_food_indices = random.sample(range(len(foods_sorted)), n)
     for i in random_food_indices:
@@ -108,75 +247,994 @@ def pick_n_random_classes(n):
 
 
 n = 101
-food_list = foods_sorted
 
-import tensorflow as tf
-import tensorflow.keras.backend as K
-from tensorflow.keras import regularizers
-from tensorflow.keras.applications.inception_v3 import InceptionV3
-from tensorflow.keras.models import Sequential, Model, load_model
-from tensorflow.keras.layers import Dense, Dropout, Activation, Flatten
-from tensorflow.keras.layers import Convolution2D, MaxPooling2D, ZeroPadding2D, GlobalAveragePooling2D, AveragePooling2D
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from tensorflow.keras.callbacks import ModelCheckpoint, CSVLogger
-from tensorflow.keras.optimizers import SGD
-
-def training():
-    K.clear_session()
+import math
+import time
+import contextlib
+import subprocess
+import sys
+import queue
+import threading
+from collections import deque
+
+# tf.data replacement for ImageDataGenerator.flow_from_directory
+# Class indices are the sorted sub-directory names, the same as flow_from_directory,
+# JPEG decode and augmentation run in parallel and batches are prefetched
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+# Value of tf.data.experimental.AUTOTUNE, kept here so TensorFlow is not needed to define defaults
+AUTOTUNE = -1
+
+# With subset, only those class folders are listed but labels still index class_names
+def list_image_files(data_dir, class_names=None, subset=None):
+    if class_names is None:
+        class_names = sorted(d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+    paths, labels = [], []
+    for index, food in enumerate(class_names):
+        if subset is not None and food not in subset:
+            continue
+        for f in sorted(os.listdir(os.path.join(data_dir, food))):
+            if f.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(data_dir, food, f))
+                labels.append(index)
+    return paths, labels, class_names
+
+
+def decode_and_resize(path, img_size=(299, 299)):
+    import tensorflow as tf
+    img = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    img = tf.image.resize(img, img_size, method='nearest')
+    img.set_shape(tuple(img_size) + (3,))
+    return img
+
+
+# Same transformations as ImageDataGenerator(shear_range=0.2, zoom_range=0.2, horizontal_flip=True):
+# shear is an angle in degrees, zoom is drawn independently per axis in [0.8, 1.2]
+# and the border is filled with the nearest pixel.
+# seed is a shape [2] integer tensor. Only stateless random ops are used, so the same seed
+# gives the same transformation and a tf.data iterator over augmented images can be checkpointed
+def augment_image(img, seed, shear_range=0.2, zoom_range=0.2):
+    import tensorflow as tf
+    height = tf.cast(tf.shape(img)[0], tf.float32)
+    width = tf.cast(tf.shape(img)[1], tf.float32)
+    seeds = tf.random.experimental.stateless_split(seed, 4)
+    shear = tf.random.stateless_uniform([], seeds[0], -shear_range, shear_range) * math.pi / 180.
+    zx = tf.random.stateless_uniform([], seeds[1], 1. - zoom_range, 1. + zoom_range)
+    zy = tf.random.stateless_uniform([], seeds[2], 1. - zoom_range, 1. + zoom_range)
+
+    # Output -> input mapping, centered on the image
+    a0, a1 = zx, -tf.sin(shear) * zy
+    b0, b1 = tf.constant(0.), tf.cos(shear) * zy
+    cx, cy = (width - 1.) / 2., (height - 1.) / 2.
+    transform = tf.stack([a0, a1, cx - a0 * cx - a1 * cy,
+                          b0, b1, cy - b0 * cx - b1 * cy,
+                          0., 0.])
+    img = tf.raw_ops.ImageProjectiveTransformV2(
+        images=tf.expand_dims(img, 0),
+        transforms=tf.expand_dims(transform, 0),
+        output_shape=tf.shape(img)[:2],
+        interpolation='BILINEAR',
+        fill_mode='NEAREST')[0]
+    return tf.image.stateless_random_flip_left_right(img, seeds[3])
+
+
+# Per-image augmentation seed: a fixed seed for the dataset and the position of the image
+# in the stream, which an iterator checkpoint restores along with everything else
+def augment_seed(seed, index):
+    import tensorflow as tf
+    return tf.stack([tf.constant(seed, tf.int64), tf.cast(index, tf.int64)])
+
+
+def make_dataset(data_dir, batch_size=16, training=False, img_size=(299, 299), class_names=None,
+                 num_parallel_calls=AUTOTUNE, prefetch=AUTOTUNE, seed=None, augment=None, num_shards=1, shard_index=0,
+                 subset=None):
+    import tensorflow as tf
+    paths, labels, class_names = list_image_files(data_dir, class_names, subset)
+    n_classes = len(class_names)
+    if augment is None:
+        augment = training
+    aug_seed = seed if seed is not None else random.randrange(2 ** 31)
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    if num_shards > 1:
+        ds = ds.shard(num_shards, shard_index)
+    if training:
+        # Shuffle the file names, not the decoded images, so the buffer stays small
+        ds = ds.shuffle(len(paths) // num_shards + 1, seed=seed, reshuffle_each_iteration=True)
+        # Repeat before numbering the images, so every epoch gets new augmentation seeds
+        ds = ds.repeat()
+
+    def load(index, example):
+        path, label = example
+        img = tf.cast(decode_and_resize(path, img_size), tf.float32)
+        if augment:
+            img = augment_image(img, augment_seed(aug_seed, index))
+        return img / 255., tf.one_hot(label, n_classes)
+
+    ds = ds.enumerate().map(load, num_parallel_calls=num_parallel_calls)
+    ds = ds.batch(batch_size, drop_remainder=training)
+    ds = ds.prefetch(prefetch)
+    return ds, len(paths), class_names
+
+
+# Pre-decoded dataset cache
+# Each class is stored once as a uint8 (count, 299, 299, 3) .npy file that is memory-mapped at
+# training time, so epochs stream straight from disk without any JPEG decode.
+# index.json records the image size and the source files of every class: a rebuild only
+# processes classes that are new or whose folder changed (e.g. after editing classes.txt)
+def write_json_atomic(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def build_image_cache(data_dir, cache_dir, class_names=None, img_size=(299, 299), workers=8):
+    import numpy as np
+    from numpy.lib.format import open_memmap
+    from tensorflow.keras.preprocessing import image
+    if class_names is None:
+        class_names = load_classes()
+    class_names = [food for food in class_names if os.path.isdir(os.path.join(data_dir, food))]
+    os.makedirs(cache_dir, exist_ok=True)
+
+    index_path = os.path.join(cache_dir, 'index.json')
+    index = {'img_size': list(img_size), 'classes': {}}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index['img_size'] != list(img_size):
+            raise ValueError("Cache in %s was built at %s, not %s" % (cache_dir, index['img_size'], list(img_size)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for food in class_names:
+            paths, _, _ = list_image_files(data_dir, [food])
+            files = [os.path.basename(p) for p in paths]
+            entry = index['classes'].get(food)
+            if entry is not None and entry['files'] == files and os.path.exists(os.path.join(cache_dir, entry['file'])):
+                continue
+
+            print("Caching", len(files), "images of", food)
+            filename = food + '.npy'
+            tmp = os.path.join(cache_dir, filename + '.tmp')
+            out = open_memmap(tmp, mode='w+', dtype=np.uint8, shape=(len(paths),) + tuple(img_size) + (3,))
+
+            def load(i, out=out):
+                out[i] = image.img_to_array(image.load_img(paths[i], target_size=img_size), dtype='uint8')
+
+            list(pool.map(load, range(len(paths))))
+            out.flush()
+            del out
+            os.replace(tmp, os.path.join(cache_dir, filename))
+
+            # Record each finished class straight away so an interrupted build resumes from here
+            index['classes'][food] = {'file': filename, 'count': len(files), 'files': files}
+            write_json_atomic(index, index_path)
+
+    print("Caching Done#")
+    return Path(cache_dir)
+
+
+# Builds dataset_cache/train and dataset_cache/test from dest_train and dest_test
+def build_dataset_cache(cache_dir='dataset_cache', class_names=None, workers=8):
+    build_image_cache(dest_train, os.path.join(cache_dir, 'train'), class_names, workers=workers)
+    build_image_cache(dest_test, os.path.join(cache_dir, 'test'), class_names, workers=workers)
+
+
+def load_image_cache(cache_dir, class_names=None):
+    import numpy as np
+    with open(os.path.join(cache_dir, 'index.json')) as f:
+        index = json.load(f)
+    if class_names is None:
+        class_names = sorted(index['classes'])
+    arrays = [np.load(os.path.join(cache_dir, index['classes'][food]['file']), mmap_mode='r')
+              for food in class_names]
+    return arrays, class_names
+
+
+# Yields (uint8 images, class indices) batches gathered from the per-class memmaps
+def iter_cache_batches(arrays, batch_size=16, shuffle=False, rng=None, num_shards=1, shard_index=0):
+    import numpy as np
+    offsets = np.cumsum([0] + [len(a) for a in arrays])
+    order = np.arange(offsets[-1])[shard_index::num_shards]
+    if shuffle:
+        order = (rng or np.random).permutation(order)
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        classes = np.searchsorted(offsets, indices, side='right') - 1
+        batch = np.empty((len(indices),) + arrays[0].shape[1:], dtype=np.uint8)
+        for c in np.unique(classes):
+            # Read each class in file order to keep the page cache access sequential
+            sel = np.nonzero(classes == c)[0]
+            local = indices[sel] - offsets[c]
+            sort = np.argsort(local)
+            batch[sel[sort]] = arrays[c][local[sort]]
+        yield batch, classes
+
+
+def make_cached_dataset(cache_dir, batch_size=16, training=False, class_names=None,
+                        num_parallel_calls=AUTOTUNE, prefetch=AUTOTUNE, seed=None, num_shards=1, shard_index=0):
+    import numpy as np
+    import tensorflow as tf
+    arrays, class_names = load_image_cache(cache_dir, class_names)
+    n_classes = len(class_names)
+    aug_seed = seed if seed is not None else random.randrange(2 ** 31)
+    nb_samples = sum(len(a) for a in arrays)
+    img_shape = arrays[0].shape[1:]
+
+    def generator():
+        rng = np.random.RandomState(seed)
+        while True:
+            for batch, classes in iter_cache_batches(arrays, batch_size, training, rng, num_shards, shard_index):
+                if training and len(batch) < batch_size:
+                    continue
+                yield batch, classes
+            if not training:
+                return
+
+    ds = tf.data.Dataset.from_generator(
+        generator,
+        output_signature=(tf.TensorSpec((None,) + img_shape, tf.uint8),
+                          tf.TensorSpec((None,), tf.int64)))
+
+    def load(index, batch):
+        imgs, labels = batch
+        imgs = tf.cast(imgs, tf.float32)
+        if training:
+            positions = index * batch_size + tf.range(tf.shape(labels, out_type=tf.int64)[0])
+            imgs = tf.map_fn(lambda args: augment_image(args[0], augment_seed(aug_seed, args[1])), (imgs, positions),
+                             fn_output_signature=tf.float32)
+        return imgs / 255., tf.one_hot(labels, n_classes)
+
+    ds = ds.enumerate().map(load, num_parallel_calls=num_parallel_calls)
+    ds = ds.prefetch(prefetch)
+    return ds, nb_samples, class_names
+
+
+# Classification head on top of the 2048-d pooled InceptionV3 features
+# The layers are named so the head weights can be moved between the full model
+# and the head-only model trained on cached bottleneck features
+def build_head(x, n_classes):
+    from tensorflow.keras import regularizers
+    from tensorflow.keras.layers import Dense, Dropout
+    x = Dense(128, activation='relu', name='fc_128')(x)
+    x = Dropout(0.2, name='fc_dropout')(x)
+    # The softmax always runs in float32, also under a mixed precision policy
+    return Dense(n_classes, kernel_regularizer=regularizers.l2(0.005), activation='softmax', name='predictions',
+                 dtype='float32')(x)
+
+
+def build_model(n_classes, weights='imagenet'):
+    from tensorflow.keras.applications.inception_v3 import InceptionV3
+    from tensorflow.keras.layers import GlobalAveragePooling2D
+    from tensorflow.keras.models import Model
+    inception = InceptionV3(weights=weights, include_top=False)
+    x = inception.output
+    x = GlobalAveragePooling2D(name='avg_pool')(x)
+    predictions = build_head(x, n_classes)
+    return Model(inputs=inception.input, outputs=predictions)
+
+
+# Opt-in fast mode for CPU training boxes: bfloat16 mixed precision when the CPU
+# has native bf16 instructions, and an XLA-compiled train step
+def cpu_supports_bf16():
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = set(f.read().split())
+    except OSError:
+        return False
+    return bool(flags & {'avx512_bf16', 'amx_bf16'})
+
+
+def set_precision(fast=False):
+    import tensorflow as tf
+    if fast and cpu_supports_bf16():
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    else:
+        if fast:
+            print("CPU has no bfloat16 support, training in float32")
+        tf.keras.mixed_precision.set_global_policy('float32')
+    return tf.keras.mixed_precision.global_policy().name
+
+
+# Reports training images/sec at the end of every epoch, the first step of
+# each epoch is left out since it includes tracing and compilation.
+# The Keras callback class is only created on first use, when TensorFlow is imported
+@functools.lru_cache()
+def throughput_logger_class():
+    import tensorflow as tf
+
+    class ThroughputLogger(tf.keras.callbacks.Callback):
+        def __init__(self, batch_size):
+            super(ThroughputLogger, self).__init__()
+            self.batch_size = batch_size
+            self.images_per_sec = []
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.steps = 0
+            self.start = None
+
+        def on_train_batch_end(self, batch, logs=None):
+            if self.start is None:
+                self.start = time.perf_counter()
+            else:
+                self.steps += 1
+
+        def on_epoch_end(self, epoch, logs=None):
+            if self.steps:
+                ips = self.steps * self.batch_size / (time.perf_counter() - self.start)
+                self.images_per_sec.append(ips)
+                print("Epoch %d: %.1f images/sec" % (epoch + 1, ips))
+                if logs is not None:
+                    logs['images_per_sec'] = ips
+
+    return ThroughputLogger
+
+
+def make_throughput_logger(batch_size):
+    return throughput_logger_class()(batch_size)
+
+
+# Per-step training instrumentation
+# Every step appends one JSON line to the profile log:
+#   {"step": 812, "data_wait_ms": 3.1, "fwd_bwd_ms": 402.7, "optimizer_ms": 21.4, "step_ms": 427.2,
+#    "images_per_sec": 37.5, "rss_mb": 5120.3, "queue_depth": null}
+# data_wait_ms is the time the training loop blocked waiting for the next batch, so a
+# data_wait_ms / step_ms ratio above stall_threshold over the last `window` steps means the
+# input pipeline, not the model, limits training and a warning is printed.
+# Phases that cannot be measured on a given path are written as null
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2. ** 20
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000., 3)
+
+
+class StepProfiler(object):
+    def __init__(self, log_path='food101/steps.jsonl', batch_size=16, stall_threshold=0.2, window=50):
+        os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+        self.log = open(log_path, 'a')
+        self.batch_size = batch_size
+        self.stall_threshold = stall_threshold
+        self.window = deque(maxlen=window)
+        self.since_warning = window
+        self.steps = 0
+        self.totals = defaultdict(float)
+
+    def record(self, step, step_time, data_wait=None, forward_backward=None, optimizer=None, queue_depth=None):
+        record = {'step': step,
+                  'data_wait_ms': _ms(data_wait),
+                  'fwd_bwd_ms': _ms(forward_backward),
+                  'optimizer_ms': _ms(optimizer),
+                  'step_ms': _ms(step_time),
+                  'images_per_sec': round(self.batch_size / step_time, 2) if step_time > 0 else None,
+                  'rss_mb': round(current_rss_mb(), 1),
+                  'queue_depth': queue_depth}
+        self.log.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.steps += 1
+        for key in ('data_wait_ms', 'fwd_bwd_ms', 'optimizer_ms', 'step_ms'):
+            if record[key] is not None:
+                self.totals[key] += record[key]
+
+        if data_wait is not None:
+            self.window.append((data_wait, step_time))
+            self.since_warning += 1
+            ratio = self.stall_ratio()
+            # At most one warning per window so a stalled run does not flood the console
+            if len(self.window) == self.window.maxlen and ratio > self.stall_threshold \
+                    and self.since_warning >= self.window.maxlen:
+                self.since_warning = 0
+                print("WARNING: step %d input stall, %.0f%% of the last %d steps spent waiting for data%s"
+                      % (step, 100 * ratio, len(self.window),
+                         '' if queue_depth is None else ' (queue depth %d)' % queue_depth))
+        return record
+
+    def stall_ratio(self):
+        total = sum(t for _, t in self.window)
+        return sum(w for w, _ in self.window) / total if total > 0 else 0.
+
+    def summary(self):
+        summary = {key[:-3] + '_mean_ms': round(value / self.steps, 3) for key, value in self.totals.items()}
+        summary.update(steps=self.steps, peak_rss_mb=round(peak_rss_mb(), 1))
+        if summary.get('step_mean_ms'):
+            summary['images_per_sec'] = round(1000. * self.batch_size / summary['step_mean_ms'], 2)
+        return summary
+
+    def close(self):
+        self.log.close()
+
+
+# Keras callback for model.fit(): fit reads the batch inside its compiled train function, so the
+# callback swaps in one that pulls the batch with an eager next() first and times it as the data
+# wait, then runs the same train step. Forward/backward and the optimizer stay fused and are null,
+# use resumable_training(profile_log=...) for that breakdown
+@functools.lru_cache()
+def step_profiler_callback_class():
+    import tensorflow as tf
+
+    class StepProfilerCallback(tf.keras.callbacks.Callback):
+        def __init__(self, profiler):
+            super(StepProfilerCallback, self).__init__()
+            self.profiler = profiler
+            self.step = 0
+            self.data_wait = None
+
+        def on_train_begin(self, logs=None):
+            model = self.model
+            strategy = model.distribute_strategy
+            run_step = tf.function(model.train_step, jit_compile=True) if model.jit_compile else model.train_step
+
+            @tf.function(reduce_retracing=True)
+            def step_on_data(data):
+                outputs = strategy.run(run_step, args=(data,))
+                return tf.nest.map_structure(lambda v: strategy.experimental_local_results(v)[0], outputs)
+
+            def train_function(iterator):
+                start = time.perf_counter()
+                data = next(iterator)
+                self.data_wait = time.perf_counter() - start
+                return step_on_data(data)
+
+            model.train_function = train_function
+
+        def on_train_batch_begin(self, batch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_train_batch_end(self, batch, logs=None):
+            self.step += 1
+            self.profiler.record(self.step, time.perf_counter() - self.start, self.data_wait)
+
+        def on_train_end(self, logs=None):
+            print("Step profile:", json.dumps(self.profiler.summary()))
+            self.profiler.close()
+
+    return StepProfilerCallback
+
+
+def make_step_profiler_callback(log_path, batch_size, stall_threshold=0.2):
+    return step_profiler_callback_class()(StepProfiler(log_path, batch_size, stall_threshold))
+
+
+def training(batch_size=16, num_parallel_calls=AUTOTUNE, cache_dir=None, model=None, fast=False, strategy=None,
+             lr=0.0001, profile_log=None, stall_threshold=0.2):
+    import tensorflow.keras.backend as K
+    from tensorflow.keras.callbacks import CSVLogger
+    from tensorflow.keras.optimizers import SGD
+    if model is None:
+        K.clear_session()
+        set_precision(fast)
 
     img_width, img_height = 299, 299
-    train_data_dir = dest_train
-    validation_data_dir = dest_test
-    nb_train_samples = 75750
-    nb_validation_samples = 25250
-    batch_size = 16
-
-    train_datagen = ImageDataGenerator(
-        rescale=1. / 255,
-        shear_range=0.2,
-        zoom_range=0.2,
-        horizontal_flip=True)
-
-    test_datagen = ImageDataGenerator(rescale=1. / 255)
-
-    train_generator = train_datagen.flow_from_directory(
-        train_data_dir,
-        target_size=(img_height, img_width),
-        batch_size=batch_size,
-        class_mode='categorical')
-
-    validation_generator = test_datagen.flow_from_directory(
-        validation_data_dir,
-        target_size=(img_height, img_width),
-        batch_size=batch_size,
-        class_mode='categorical')
-
-    inception = InceptionV3(weights='imagenet', include_top=False)
-    x = inception.output
-    x = GlobalAveragePooling2D()(x)
-    x = Dense(128, activation='relu')(x)
-    x = Dropout(0.2)(x)
+    data_dirs = {'train': dest_train, 'test': dest_test}
+
+    # With a distribution strategy every input pipeline reads its own shard of the
+    # file list at the per-replica batch size
+    def make_split(split, input_context=None):
+        per_replica_batch_size, shards = batch_size, {}
+        if input_context is not None:
+            per_replica_batch_size = input_context.get_per_replica_batch_size(batch_size)
+            shards = dict(num_shards=input_context.num_input_pipelines, shard_index=input_context.input_pipeline_id)
+        if cache_dir is not None:
+            # Stream pre-decoded images built by build_dataset_cache()
+            return make_cached_dataset(
+                os.path.join(cache_dir, split),
+                batch_size=per_replica_batch_size,
+                training=split == 'train',
+                num_parallel_calls=num_parallel_calls,
+                **shards)
+        return make_dataset(
+            data_dirs[split],
+            batch_size=per_replica_batch_size,
+            training=split == 'train',
+            img_size=(img_height, img_width),
+            num_parallel_calls=num_parallel_calls,
+            **shards)
+
+    train_generator, nb_train_samples, _ = make_split('train')
+    validation_generator, nb_validation_samples, _ = make_split('test')
+    if strategy is not None:
+        train_generator = strategy.distribute_datasets_from_function(lambda ctx: make_split('train', ctx)[0])
+        validation_generator = strategy.distribute_datasets_from_function(lambda ctx: make_split('test', ctx)[0])
+
+    with strategy.scope() if strategy is not None else contextlib.nullcontext():
+        if model is None:
+            model = build_model(n)
+        model.compile(optimizer=SGD(learning_rate=lr, momentum=0.9), loss='categorical_crossentropy',
+                      metrics=['accuracy'], jit_compile=fast)
+    # checkpointer = ModelCheckpoint(filepath='food101/best_model_101class.hdf5', verbose=1, save_best_only=True)
+    callbacks = [make_throughput_logger(batch_size)]
+    if is_chief():
+        callbacks.append(CSVLogger('food101/history.log'))
+        if profile_log:
+            callbacks.append(make_step_profiler_callback(profile_log, batch_size, stall_threshold))
 
-    predictions = Dense(n, kernel_regularizer=regularizers.l2(0.005), activation='softmax')(x)
+    history = model.fit(train_generator,
+                        steps_per_epoch = nb_train_samples // batch_size,
+                        validation_data=validation_generator,
+                        validation_steps=nb_validation_samples // batch_size,
+                        epochs=10,
+                        verbose=1 if is_chief() else 0,
+                        callbacks=callbacks)
 
-    model = Model(inputs=inception.input, outputs=predictions)
-    model.compile(optimizer=SGD(lr=0.0001, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy'])
-    # checkpointer = ModelCheckpoint(filepath='food101/best_model_101class.hdf5', verbose=1, save_best_only=True)
-    csv_logger = CSVLogger('food101/history.log')
 
-    history = model.fit_generator(train_generator,
-                                  steps_per_epoch = nb_train_samples // batch_size,
-                                  validation_data=validation_generator,
-                                  validation_steps=nb_validation_samples // batch_size,
-                                  epochs=10,
-                                  verbose=1,
-                                  callbacks=[csv_logger])
+    if is_chief():
+        model.save('model_trained_101class.hdf5')
+    return model
 
 
+# Data-parallel training
+# Each worker process runs distributed_training() with TF_CONFIG describing the cluster,
+# gradients are all-reduced synchronously every step. The global batch and the learning
+# rate grow linearly with the number of workers. On several hosts start one worker per
+# host with its own TF_CONFIG, on one machine use launch_local_workers()
+def is_chief():
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    task = tf_config.get('task', {})
+    if 'chief' in tf_config.get('cluster', {}):
+        return task.get('type') == 'chief'
+    return task.get('index', 0) == 0
+
+
+def distributed_training(per_worker_batch_size=16, base_lr=0.0001, threads=None, **kwargs):
+    import tensorflow as tf
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+    communication = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication)
+
+    replicas = strategy.num_replicas_in_sync
+    batch_size = per_worker_batch_size * replicas
+    lr = base_lr * replicas
+    print("Training on %d replicas, global batch size %d, learning rate %g" % (replicas, batch_size, lr))
+    return training(batch_size=batch_size, lr=lr, strategy=strategy, **kwargs)
+
+
+# Waits for all worker processes, polling them together: as soon as one exits with an error
+# the others are terminated, since the survivors would block forever in the next all-reduce
+def wait_for_workers(workers, name='worker', poll_interval=0.5):
+    while True:
+        codes = [w.poll() for w in workers]
+        failed = [(i, code) for i, code in enumerate(codes) if code]
+        if failed:
+            for w in workers:
+                if w.poll() is None:
+                    w.terminate()
+            for w in workers:
+                w.wait()
+            raise RuntimeError("%s %d exited with code %d" % (name.capitalize(), failed[0][0], failed[0][1]))
+        if all(code == 0 for code in codes):
+            return codes
+        time.sleep(poll_interval)
+
+
+# Starts num_workers CPU worker processes on this machine, splitting the cores between them
+def launch_local_workers(num_workers=2, base_port=23456, threads_per_worker=None, **kwargs):
+    hosts = ['localhost:%d' % (base_port + i) for i in range(num_workers)]
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+    kwargs = dict(kwargs, threads=threads)
+    code = 'import json, my_food101; my_food101.distributed_training(**json.loads(%r))' % json.dumps(kwargs)
+
+    workers = []
+    for i in range(num_workers):
+        env = dict(os.environ,
+                   TF_CONFIG=json.dumps({'cluster': {'worker': hosts}, 'task': {'type': 'worker', 'index': i}}),
+                   CUDA_VISIBLE_DEVICES='')
+        workers.append(subprocess.Popen([sys.executable, '-c', code], env=env,
+                                        cwd=os.path.dirname(os.path.abspath(__file__))))
+    return wait_for_workers(workers, 'training worker')
+
+
+# Resumable training with step-granular checkpoints
+# Replaces the notebook loop that called load_model on the best HDF5 file before every epoch.
+# Every save_every steps a checkpoint with the weights, the optimizer slots and the step counter
+# is written asynchronously; checkpoint files only become visible once complete, so a crash
+# loses at most save_every steps. The data iterator (shuffle order, position and augmentation
+# seeds) goes to <checkpoint_dir>/data with the same number, written synchronously just before:
+# an async save would serialize it on the writer thread while the loop keeps pulling batches.
+# Nothing is read back from disk inside the training loop, only once at start-up
+def resumable_training(checkpoint_dir='food101/checkpoints', save_every=500, epochs=10, batch_size=16,
+                       max_to_keep=3, fast=False, lr=0.0001, seed=0, profile_log=None, stall_threshold=0.2,
+                       weights='imagenet', batch_log=None):
+    import tensorflow as tf
+    import tensorflow.keras.backend as K
+    from tensorflow.keras.optimizers import SGD
+    K.clear_session()
+    set_precision(fast)
+
+    train_ds, nb_train_samples, class_names = make_dataset(dest_train, batch_size=batch_size, training=True, seed=seed)
+    validation_ds, nb_validation_samples, _ = make_dataset(dest_test, batch_size=batch_size, class_names=class_names)
+    steps_per_epoch = nb_train_samples // batch_size
+
+    model = build_model(len(class_names), weights=weights)
+    optimizer = SGD(learning_rate=lr, momentum=0.9)
+    model.compile(optimizer=optimizer, loss='categorical_crossentropy', metrics=['accuracy'])
+    # evaluate() would otherwise attach a new tracked function to the model while an async
+    # checkpoint of it is still being written
+    model.make_test_function()
+    iterator = iter(train_ds)
+    step = tf.Variable(0, dtype=tf.int64, trainable=False, name='step')
+
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, step=step)
+    manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=max_to_keep)
+    options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+    data_checkpoint = tf.train.Checkpoint(iterator=iterator)
+    data_manager = tf.train.CheckpointManager(data_checkpoint, os.path.join(checkpoint_dir, 'data'),
+                                              max_to_keep=max_to_keep)
+    if manager.latest_checkpoint:
+        checkpoint.restore(manager.latest_checkpoint)
+        data_checkpoint.restore(os.path.join(checkpoint_dir, 'data', 'ckpt-%d' % int(step.numpy())))
+        print("Resuming from", manager.latest_checkpoint, "at step", int(step.numpy()))
+
+    def save(number):
+        data_manager.save(checkpoint_number=number)
+        manager.save(checkpoint_number=number, options=options)
+
+    loss_fn = tf.keras.losses.CategoricalCrossentropy()
+    train_loss = tf.keras.metrics.Mean()
+    train_accuracy = tf.keras.metrics.CategoricalAccuracy()
+
+    @tf.function(jit_compile=fast)
+    def compute_gradients(imgs, labels):
+        with tf.GradientTape() as tape:
+            preds = model(imgs, training=True)
+            loss = tf.add_n([loss_fn(labels, preds)] + model.losses)
+        train_loss.update_state(loss)
+        train_accuracy.update_state(labels, preds)
+        return loss, tape.gradient(loss, model.trainable_variables)
+
+    @tf.function(jit_compile=fast)
+    def apply_gradients(grads):
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+
+    @tf.function(jit_compile=fast)
+    def train_step(imgs, labels):
+        apply_gradients(compute_gradients(imgs, labels)[1])
+
+    # Profiling runs the two halves of the step separately and waits for each to finish,
+    # which costs a little throughput. The data wait is the time spent in next(): tf.data
+    # prefetches on its own threads, and nothing else pulls from the iterator, so the saved
+    # data checkpoint always points at the next batch the loop will train on
+    profiler = StepProfiler(profile_log, batch_size, stall_threshold) if profile_log else None
+
+    # One "<step> <digest of the batch>" line per step, used by check_resume()
+    batch_logger = open(batch_log, 'a') if batch_log else None
+    csv_logger = open('food101/history.log', 'a')
+    total_steps = epochs * steps_per_epoch
+    while int(step.numpy()) < total_steps:
+        start = time.perf_counter()
+        imgs, labels = next(iterator)
+        if profiler is None:
+            train_step(imgs, labels)
+            current = int(step.assign_add(1).numpy())
+        else:
+            fetched = time.perf_counter()
+            loss, grads = compute_gradients(imgs, labels)
+            loss.numpy()
+            computed = time.perf_counter()
+            apply_gradients(grads)
+            current = int(step.assign_add(1).numpy())
+            end = time.perf_counter()
+            profiler.record(current, end - start, fetched - start, computed - fetched, end - computed)
+        if batch_logger is not None:
+            digest = hashlib.sha1(imgs.numpy().tobytes() + labels.numpy().tobytes()).hexdigest()[:16]
+            batch_logger.write('%d %s\n' % (current, digest))
+            batch_logger.flush()
+
+        if current % save_every == 0:
+            save(current)
+
+        if current % steps_per_epoch == 0:
+            epoch = current // steps_per_epoch
+            val_loss, val_accuracy = model.evaluate(validation_ds, steps=nb_validation_samples // batch_size,
+                                                    verbose=0)
+            print("Epoch %d/%d - loss: %.4f - accuracy: %.4f - val_loss: %.4f - val_accuracy: %.4f" % (
+                epoch, epochs, train_loss.result(), train_accuracy.result(), val_loss, val_accuracy))
+            csv_logger.write("%d,%f,%f,%f,%f\n" % (epoch - 1, train_accuracy.result(), train_loss.result(),
+                                                 val_accuracy, val_loss))
+            csv_logger.flush()
+            train_loss.reset_states()
+            train_accuracy.reset_states()
+
+    if int(step.numpy()) % save_every:
+        save(int(step.numpy()))
+    if hasattr(checkpoint, 'sync'):
+        checkpoint.sync()
+    csv_logger.close()
+    if batch_logger is not None:
+        batch_logger.close()
+    if profiler is not None:
+        print("Step profile:", json.dumps(profiler.summary()))
+        profiler.close()
     model.save('model_trained_101class.hdf5')
     return model
 
 
+# Resume check on a small synthetic dataset: a reference run trains straight through, a second
+# run is killed as soon as its first checkpoint is complete and then restarted. The restarted
+# run has to continue right after the checkpointed step, and every step of both runs has to
+# see the same batch, augmentation included, as the reference run. The interrupted run profiles
+# its steps, so the profiling loop is checked against the plain one as well.
+# Everything is written under root, which gets its own dataset/ and food101/ folders
+def check_resume(root=None, batch_size=4, save_every=4, epochs=2, seed=0, timeout=1800):
+    import tensorflow as tf
+    root = root or tempfile.mkdtemp(prefix='food101_resume_')
+    src = os.path.join(root, 'synthetic')
+    if not os.path.isdir(os.path.join(src, 'images')):
+        make_synthetic_dataset(src, seed=seed)
+    for split in ('train', 'test'):
+        prepare_data(os.path.join(src, 'meta', split + '.txt'), os.path.join(src, 'images'),
+                     os.path.join(root, 'dataset', split))
+    os.makedirs(os.path.join(root, 'food101'), exist_ok=True)
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def start(name):
+        kwargs = dict(checkpoint_dir=os.path.join('food101', name), save_every=save_every, epochs=epochs,
+                      batch_size=batch_size, seed=seed, weights=None, batch_log=os.path.join('food101', name + '.txt'))
+        if name == 'interrupted':
+            kwargs['profile_log'] = os.path.join('food101', name + '.jsonl')
+        code = ('import json, sys; sys.path.insert(0, %r); import my_food101; '
+                'my_food101.resumable_training(**json.loads(%r))' % (module_dir, json.dumps(kwargs)))
+        return subprocess.Popen([sys.executable, '-c', code], cwd=root)
+
+    def read_log(name):
+        with open(os.path.join(root, 'food101', name + '.txt')) as f:
+            return [(int(step), digest) for step, digest in (line.split() for line in f)]
+
+    for name in ('reference', 'interrupted'):
+        shutil.rmtree(os.path.join(root, 'food101', name), ignore_errors=True)
+        for ext in ('.txt', '.jsonl'):
+            if os.path.exists(os.path.join(root, 'food101', name + ext)):
+                os.remove(os.path.join(root, 'food101', name + ext))
+    if start('reference').wait(timeout):
+        raise RuntimeError("reference run failed")
+    reference = dict(read_log('reference'))
+
+    checkpoint_dir = os.path.join(root, 'food101', 'interrupted')
+    process = start('interrupted')
+    deadline = time.time() + timeout
+    while tf.train.latest_checkpoint(checkpoint_dir) is None:
+        if process.poll() is not None or time.time() > deadline:
+            process.kill()
+            raise RuntimeError("interrupted run ended before writing a checkpoint")
+        time.sleep(0.2)
+    process.kill()
+    process.wait()
+    saved_step = int(tf.train.latest_checkpoint(checkpoint_dir).rsplit('-', 1)[1])
+    killed_at = len(read_log('interrupted'))
+    if start('interrupted').wait(timeout):
+        raise RuntimeError("restarted run failed")
+
+    log = read_log('interrupted')
+    resumed = log[killed_at:]
+    result = {'checkpoint_step': saved_step,
+              'killed_after_step': log[killed_at - 1][0] if killed_at else 0,
+              'resumed_at_step': resumed[0][0] if resumed else None,
+              'final_step': log[-1][0],
+              'total_steps': max(reference),
+              'mismatched_batches': sorted(step for step, digest in log if reference.get(step) != digest)}
+    result['ok'] = (result['resumed_at_step'] == saved_step + 1 and result['final_step'] == result['total_steps']
+                    and not result['mismatched_batches'])
+    print(json.dumps(result))
+    if not result['ok']:
+        print("WARNING: resumed training did not continue where the checkpoint left off")
+    return result
+
+
+# Progressive-resolution and class-subset curriculum
+# Replaces the notebook habit of training on 3 or 11 random classes because full epochs were
+# too slow. Each stage is (image size, number of classes, epochs) and trains the same model
+# further: InceptionV3 without its top accepts any input size, and the 101-way head is kept
+# for every stage, so a stage on a class subset trains with the full label indices and the
+# next stage adds classes instead of replacing the head. Class subsets are nested, drawn from
+# one seeded shuffle of the class list. Early low-resolution stages cost roughly
+# (size / 299)^2 of a full-size epoch, the last stage should run at 299 on all classes.
+# The per-stage wall time and validation accuracy go to food101/curriculum.json
+DEFAULT_CURRICULUM = ((160, 11, 2), (224, 51, 2), (299, None, 3))
+
+
+def parse_curriculum(spec):
+    # "160:11:2,224:51:2,299:all:3"
+    stages = []
+    for stage in spec.split(','):
+        size, classes, epochs = stage.split(':')
+        stages.append((int(size), None if classes == 'all' else int(classes), int(epochs)))
+    return tuple(stages)
+
+
+def curriculum_training(stages=DEFAULT_CURRICULUM, batch_size=16, fast=False, lr=0.0001, seed=0,
+                        num_parallel_calls=AUTOTUNE, report_path='food101/curriculum.json'):
+    import tensorflow.keras.backend as K
+    from tensorflow.keras.callbacks import CSVLogger
+    from tensorflow.keras.optimizers import SGD
+    K.clear_session()
+    set_precision(fast)
+
+    class_names = sorted(d for d in os.listdir(dest_train) if os.path.isdir(os.path.join(dest_train, d)))
+    order = list(class_names)
+    random.Random(seed).shuffle(order)
+
+    model = build_model(len(class_names))
+    model.compile(optimizer=SGD(learning_rate=lr, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy'],
+                  jit_compile=fast)
+    csv_logger = CSVLogger('food101/history.log', append=True)
+
+    report, epoch, start = [], 0, time.perf_counter()
+    for size, n_classes, epochs in stages:
+        n_classes = min(n_classes or len(class_names), len(class_names))
+        subset = set(order[:n_classes]) if n_classes < len(class_names) else None
+        splits = {}
+        for split, data_dir in (('train', dest_train), ('test', dest_test)):
+            splits[split] = make_dataset(data_dir, batch_size=batch_size, training=split == 'train',
+                                         img_size=(size, size), class_names=class_names, subset=subset,
+                                         num_parallel_calls=num_parallel_calls, seed=seed)
+        (train_ds, nb_train_samples, _), (validation_ds, nb_validation_samples, _) = splits['train'], splits['test']
+
+        print("Stage %d/%d: %dx%d, %d classes, %d epochs" % (len(report) + 1, len(stages), size, size,
+                                                            n_classes, epochs))
+        stage_start = time.perf_counter()
+        throughput = make_throughput_logger(batch_size)
+        history = model.fit(train_ds,
+                            steps_per_epoch=nb_train_samples // batch_size,
+                            validation_data=validation_ds,
+                            validation_steps=nb_validation_samples // batch_size,
+                            initial_epoch=epoch,
+                            epochs=epoch + epochs,
+                            callbacks=[throughput, csv_logger])
+        epoch += epochs
+        report.append({'img_size': size,
+                       'classes': n_classes,
+                       'epochs': epochs,
+                       'seconds': round(time.perf_counter() - stage_start, 1),
+                       'images_per_sec': throughput.images_per_sec[-1] if throughput.images_per_sec else None,
+                       'val_accuracy': history.history['val_accuracy'][-1]})
+
+    total = time.perf_counter() - start
+    print("Curriculum finished in %.0fs, final val_accuracy %.4f" % (total, report[-1]['val_accuracy']))
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    write_json_atomic({'stages': report, 'seconds': round(total, 1), 'batch_size': batch_size,
+                       'precision': 'fast' if fast else 'float32'}, report_path)
+    model.save('model_trained_101class.hdf5')
+    return model, report
+
+
+# Compares training images/sec of the default float32 path against fast mode
+# on synthetic 299x299 batches, so no dataset is needed
+def benchmark_training_modes(steps=30, batch_size=16, img_size=(299, 299)):
+    import tensorflow as tf
+    import tensorflow.keras.backend as K
+    from tensorflow.keras.optimizers import SGD
+    imgs = tf.random.uniform((batch_size,) + tuple(img_size) + (3,))
+    labels = tf.one_hot(tf.random.uniform((batch_size,), maxval=n, dtype=tf.int32), n)
+    ds = tf.data.Dataset.from_tensors((imgs, labels)).repeat()
+
+    results = {}
+    for fast in (False, True):
+        K.clear_session()
+        policy = set_precision(fast)
+        model = build_model(n, weights=None)
+        model.compile(optimizer=SGD(learning_rate=0.0001, momentum=0.9), loss='categorical_crossentropy',
+                      jit_compile=fast)
+        throughput = make_throughput_logger(batch_size)
+        model.fit(ds, steps_per_epoch=steps, epochs=1, verbose=0, callbacks=[throughput])
+        results['fast' if fast else 'default'] = {'policy': policy, 'images_per_sec': throughput.images_per_sec[-1]}
+    set_precision(False)
+
+    results['speedup'] = results['fast']['images_per_sec'] / results['default']['images_per_sec']
+    print("default: %.1f images/sec, fast (%s): %.1f images/sec, speedup x%.2f" % (
+        results['default']['images_per_sec'], results['fast']['policy'],
+        results['fast']['images_per_sec'], results['speedup']))
+    return results
+
+
+# Bottleneck features for training the head with a frozen InceptionV3 base
+# The pooled 2048-d features are extracted once and stored as float16 arrays:
+#   <features_dir>/train_view0.npy      non-augmented train images
+#   <features_dir>/train_view<k>.npy    k-th augmented view of the train images
+#   <features_dir>/test_view0.npy       non-augmented test images
+#   <features_dir>/{train,test}_labels.npy
+# The head then trains on these arrays in seconds per epoch
+def extract_bottleneck_features(features_dir='food101/bottleneck', aug_views=0, batch_size=64):
+    import numpy as np
+    from numpy.lib.format import open_memmap
+    from tensorflow.keras.applications.inception_v3 import InceptionV3
+    from tensorflow.keras.layers import GlobalAveragePooling2D
+    from tensorflow.keras.models import Model
+    os.makedirs(features_dir, exist_ok=True)
+    inception = InceptionV3(weights='imagenet', include_top=False)
+    extractor = Model(inputs=inception.input, outputs=GlobalAveragePooling2D()(inception.output))
+
+    jobs = [('test', dest_test, 0)] + [('train', dest_train, v) for v in range(aug_views + 1)]
+    for split, data_dir, view in jobs:
+        path = os.path.join(features_dir, '%s_view%d.npy' % (split, view))
+        if os.path.exists(path):
+            continue
+        ds, nb_samples, _ = make_dataset(data_dir, batch_size=batch_size, augment=view > 0)
+        print("Extracting", split, "features, view", view)
+
+        out = open_memmap(path + '.tmp', mode='w+', dtype=np.float16, shape=(nb_samples, 2048))
+        labels = np.empty(nb_samples, dtype=np.int16)
+        start = 0
+        for imgs, one_hot in ds:
+            features = extractor.predict_on_batch(imgs)
+            out[start:start + len(features)] = features
+            labels[start:start + len(features)] = np.argmax(one_hot, axis=1)
+            start += len(features)
+        out.flush()
+        del out
+        os.replace(path + '.tmp', path)
+        np.save(os.path.join(features_dir, split + '_labels.npy'), labels)
+
+    print("Extraction Done#")
+    return Path(features_dir)
+
+
+# Every epoch each sample is drawn from one of the stored views at random
+def iter_feature_batches(views, labels, n_classes, batch_size=256, shuffle=False, rng=None):
+    import numpy as np
+    rng = rng or np.random.RandomState()
+    while True:
+        order = rng.permutation(len(labels)) if shuffle else np.arange(len(labels))
+        view_of = rng.randint(len(views), size=len(labels))
+        for start in range(0, len(order), batch_size):
+            indices = np.sort(order[start:start + batch_size])
+            x = np.empty((len(indices), views[0].shape[1]), dtype=np.float32)
+            for v, features in enumerate(views):
+                sel = view_of[indices] == v
+                x[sel] = features[indices[sel]]
+            yield x, np.eye(n_classes, dtype=np.float32)[labels[indices]]
+
+
+def train_bottleneck_head(features_dir='food101/bottleneck', epochs=50, batch_size=256):
+    import numpy as np
+    import tensorflow as tf
+    import tensorflow.keras.backend as K
+    from tensorflow.keras.callbacks import CSVLogger
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.optimizers import SGD
+    K.clear_session()
+    train_views = [np.load(p, mmap_mode='r') for p in sorted(Path(features_dir).glob('train_view*.npy'))]
+    test_views = [np.load(os.path.join(features_dir, 'test_view0.npy'), mmap_mode='r')]
+    train_labels = np.load(os.path.join(features_dir, 'train_labels.npy'))
+    test_labels = np.load(os.path.join(features_dir, 'test_labels.npy'))
+
+    inputs = tf.keras.Input(shape=(train_views[0].shape[1],))
+    head = Model(inputs=inputs, outputs=build_head(inputs, n))
+    head.compile(optimizer=SGD(learning_rate=0.01, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy'])
+    csv_logger = CSVLogger('food101/history_head.log')
+
+    head.fit(iter_feature_batches(train_views, train_labels, n, batch_size, shuffle=True),
+             steps_per_epoch=int(math.ceil(len(train_labels) / batch_size)),
+             validation_data=iter_feature_batches(test_views, test_labels, n, batch_size),
+             validation_steps=int(math.ceil(len(test_labels) / batch_size)),
+             epochs=epochs,
+             verbose=1,
+             callbacks=[csv_logger])
+    return head
+
+
+# Two stage training: the head is trained on cached features, then copied on top of
+# InceptionV3 and the whole network is fine-tuned with training()
+def bottleneck_training(features_dir='food101/bottleneck', aug_views=0, head_epochs=50, fine_tune=True, **kwargs):
+    import tensorflow.keras.backend as K
+    extract_bottleneck_features(features_dir, aug_views)
+    head = train_bottleneck_head(features_dir, head_epochs)
+    head_weights = {layer.name: layer.get_weights() for layer in head.layers if layer.weights}
+
+    K.clear_session()
+    model = build_model(n)
+    for name, weights in head_weights.items():
+        model.get_layer(name).set_weights(weights)
+    if not fine_tune:
+        model.save('model_trained_101class.hdf5')
+        return model
+    return training(model=model, **kwargs)
+
+
 #training()
 
 """
@@ -213,21 +1271,33 @@ def plot_loss(history,title):
 ### Predicting classes for new images from internet using the best trained model
 """
 
-from tensorflow.keras.preprocessing import image
-import matplotlib.pyplot as plt
-import os
-import numpy as np
-def predict_class(model, images, show=True):
+# Input size a model was built for. The InceptionV3 models accept any size and get 299x299,
+# the default for every target_size=None below
+def model_input_size(model, default=(299, 299)):
+    shape = getattr(model, 'input_shape', None)
+    if not shape or shape[1] is None or shape[2] is None:
+        return tuple(default)
+    return int(shape[1]), int(shape[2])
+
+
+def predict_class(model, images, show=True, calibration=None):
+    import numpy as np
+    import matplotlib.pyplot as plt
+    from tensorflow.keras.preprocessing import image
     for img in images:
-        img = image.load_img(img, target_size=(299, 299))
+        img = image.load_img(img, target_size=model_input_size(model))
         img = image.img_to_array(img)
         img = np.expand_dims(img, axis=0)
         img /= 255.
 
         pred = model.predict(img)
+        if calibration is not None:
+            pred = apply_temperature(pred, calibration['temperature'])
         index = np.argmax(pred)
         # food_list.sort()
-        pred_value = food_list[index]
+        pred_value = model_classes()[index]
+        if calibration is not None and pred[0, index] < calibration['threshold']:
+            pred_value = NO_CLASS
         if show:
             plt.imshow(img[0])
             plt.axis('off')
@@ -236,6 +1306,101 @@ def predict_class(model, images, show=True):
     return pred_value
 
 
+# Batched inference: images are decoded and resized on a thread pool while the
+# previous batch is running through the model, and every batch is padded to
+# the same fixed size so predict always sees the same input shape
+def load_image(path, target_size=(299, 299)):
+    from tensorflow.keras.preprocessing import image
+    img = image.load_img(path, target_size=target_size)
+    img = image.img_to_array(img)
+    img /= 255.
+    return img
+
+
+def iter_predict_batches(model, images, batch_size=32, top_k=5, workers=8, target_size=None, labels=None,
+                         tta_views=1, calibration=None):
+    import numpy as np
+    if labels is None:
+        labels = model_classes()
+    images = list(images)
+    top_k = min(top_k, len(labels))
+    target_size = tuple(target_size or model_input_size(model))
+    # With TTA the images are decoded larger so that crops of target_size can be taken
+    decode_size = tta_decode_size(target_size) if tta_views > 2 else tuple(target_size)
+
+    def decode(paths):
+        return [pool.submit(load_image, p, decode_size) for p in paths]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = decode(images[0:batch_size])
+        for start in range(0, len(images), batch_size):
+            paths = images[start:start + batch_size]
+            batch = np.zeros((batch_size,) + decode_size + (3,), dtype=np.float32)
+            for i, future in enumerate(pending):
+                batch[i] = future.result()
+            # Start decoding the next batch before running the model on this one
+            pending = decode(images[start + batch_size:start + 2 * batch_size])
+
+            if tta_views > 1:
+                preds = tta_predict(model, batch, tta_views, target_size)[:len(paths)]
+            else:
+                preds = model.predict(batch, batch_size=batch_size)[:len(paths)]
+            if calibration is not None:
+                preds = apply_temperature(preds, calibration['temperature'])
+            top = np.argsort(-preds, axis=1)[:, :top_k]
+            for path, pred, indices in zip(paths, preds, top):
+                if calibration is not None and pred[indices[0]] < calibration['threshold']:
+                    yield path, [NO_CLASS], pred[indices[:1]]
+                else:
+                    yield path, [labels[i] for i in indices], pred[indices]
+
+
+# Returns a list of (image path, top-k labels, top-k scores), one per input image
+# With a calibration (see calibrate) rejected images get ([NO_CLASS], [top score])
+def predict_batch(model, images, batch_size=32, top_k=5, workers=8, target_size=None, labels=None,
+                  tta_views=1, calibration=None):
+    return list(iter_predict_batches(model, images, batch_size, top_k, workers, target_size, labels, tta_views,
+                                     calibration))
+
+
+# Test-time augmentation
+# Views, in the order they are used: the resized image, its flip, the center crop, its flip,
+# the four corner crops and their flips (up to 12). Crops come from the image decoded at
+# target_size / 0.875. All views of a whole batch go through the model in one forward pass
+# and their log-probabilities are averaged
+TTA_CROP_FRACTION = 0.875
+MAX_TTA_VIEWS = 12
+
+def tta_decode_size(target_size=(299, 299)):
+    return tuple(int(round(s / TTA_CROP_FRACTION)) for s in target_size)
+
+
+def tta_views_batch(batch, n_views, target_size=(299, 299)):
+    import tensorflow as tf
+    h, w = target_size
+    full = tf.image.resize(batch, target_size)
+    views = [full, full[:, :, ::-1]]
+    if n_views > 2:
+        big_h, big_w = batch.shape[1], batch.shape[2]
+        top, left = (big_h - h) // 2, (big_w - w) // 2
+        offsets = [(top, left), (0, 0), (0, big_w - w), (big_h - h, 0), (big_h - h, big_w - w)]
+        crops = [batch[:, y:y + h, x:x + w] for y, x in offsets]
+        views += [crops[0], crops[0][:, :, ::-1]] + crops[1:] + [c[:, :, ::-1] for c in crops[1:]]
+    return tf.concat(views[:n_views], axis=0)
+
+
+def tta_predict(model, batch, n_views, target_size=(299, 299)):
+    import numpy as np
+    if not 1 <= n_views <= MAX_TTA_VIEWS:
+        raise ValueError("tta_views must be between 1 and %d" % MAX_TTA_VIEWS)
+    views = np.asarray(tta_views_batch(batch, n_views, target_size))
+    preds = model.predict(views, batch_size=len(views))
+    # (views * batch, classes) -> (views, batch, classes), averaged in log space
+    log_probs = np.log(np.clip(preds, 1e-7, 1.)).reshape((n_views, len(batch), -1)).mean(axis=0)
+    probs = np.exp(log_probs - log_probs.max(axis=1, keepdims=True))
+    return probs / probs.sum(axis=1, keepdims=True)
+
+
 def load_and_predict():
     # Loading the best saved model to make predictions
     # %%time
@@ -256,7 +1421,1224 @@ def load_and_predict():
     predict_class(model_best, images, True)
 
 
-load_and_predict()
+# Out-of-distribution rejection
+# calibrate() fits a softmax temperature on held-out images (minimum negative log-likelihood)
+# and picks the confidence threshold that keeps target_recall of the correctly classified
+# ones. Both are stored next to the model in <model>.calibration.json. At prediction time the
+# temperature is applied to the probabilities the model already returned and images whose top
+# score is below the threshold get NO_CLASS, so rejection costs no extra forward pass
+NO_CLASS = 'NO-CLASS'
+
+def calibration_path(model_path):
+    return model_path + '.calibration.json'
+
+
+def load_calibration(model_path):
+    path = calibration_path(model_path)
+    if not os.path.exists(path):
+        raise ValueError("No calibration for %s, run the calibrate command first" % model_path)
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_temperature(preds, temperature):
+    import numpy as np
+    logits = np.log(np.clip(preds, 1e-7, 1.)) / temperature
+    probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return probs / probs.sum(axis=1, keepdims=True)
+
+
+def calibrate(model_path='model_trained_101class.hdf5', data_dir=dest_test, max_images=5000, target_recall=0.95,
+              batch_size=64, seed=0):
+    import numpy as np
+    from tensorflow.keras.models import load_model
+    model = load_model(model_path, compile=False)
+    # Labels in the sorted folder order the model was trained with
+    paths, labels, class_names = list_image_files(data_dir)
+    if max_images is not None and max_images < len(paths):
+        keep = sorted(random.Random(seed).sample(range(len(paths)), max_images))
+        paths, labels = [paths[i] for i in keep], [labels[i] for i in keep]
+
+    # Full probability vectors: all classes as "top-k", labels being the class indices
+    preds = np.zeros((len(paths), len(class_names)), dtype=np.float32)
+    results = iter_predict_batches(model, paths, batch_size, top_k=len(class_names),
+                                   labels=list(range(len(class_names))))
+    for i, (_, indices, scores) in enumerate(results):
+        preds[i, indices] = scores
+    labels = np.asarray(labels)
+
+    temperatures = np.linspace(0.5, 5., 91)
+    nll = [-np.log(apply_temperature(preds, t)[np.arange(len(labels)), labels] + 1e-12).mean() for t in temperatures]
+    temperature = float(temperatures[int(np.argmin(nll))])
+
+    probs = apply_temperature(preds, temperature)
+    confidence = probs.max(axis=1)
+    correct = probs.argmax(axis=1) == labels
+    threshold = float(np.percentile(confidence[correct], 100 * (1 - target_recall))) if correct.any() else 0.
+    accepted = confidence >= threshold
+
+    calibration = {
+        'temperature': temperature,
+        'threshold': threshold,
+        'target_recall': target_recall,
+        'images': len(labels),
+        'accepted_fraction': float(accepted.mean()),
+        'accuracy_all': float(correct.mean()),
+        'accuracy_accepted': float(correct[accepted].mean()) if accepted.any() else 0.,
+    }
+    write_json_atomic(calibration, calibration_path(model_path))
+    print("Temperature %.2f, threshold %.4f: %.1f%% accepted, accuracy %.4f -> %.4f" % (
+        temperature, threshold, 100 * calibration['accepted_fraction'], calibration['accuracy_all'],
+        calibration['accuracy_accepted']))
+    return calibration
+
+
+# Embedding index
+# The GlobalAveragePooling2D output of the trained model is used as a 2048-d image embedding.
+# extract_embeddings stores L2-normalised float16 embeddings of a split next to its image paths,
+# build_ivf_index clusters them with spherical k-means into n_lists inverted lists and writes
+# the vectors reordered by list, so a query only scans the nprobe closest lists from disk
+def embedding_model(model):
+    from tensorflow.keras.layers import GlobalAveragePooling2D
+    from tensorflow.keras.models import Model
+    pool = [layer for layer in model.layers if isinstance(layer, GlobalAveragePooling2D)][0]
+    return Model(inputs=model.input, outputs=pool.output)
+
+
+def normalize_rows(x):
+    import numpy as np
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def embed_images(extractor, paths, batch_size=64):
+    import numpy as np
+    embeddings = np.zeros((len(paths), extractor.output_shape[-1]), dtype=np.float16)
+    for start, batch in iter_image_batches(paths, batch_size, target_size=model_input_size(extractor)):
+        features = np.asarray(extractor.predict_on_batch(batch), dtype=np.float32)
+        embeddings[start:start + len(features)] = normalize_rows(features)
+    return embeddings
+
+
+# Yields (start index, float32 batch) with images decoded on a thread pool one batch ahead
+def iter_image_batches(paths, batch_size=64, workers=8, target_size=None):
+    import numpy as np
+    target_size = tuple(target_size or model_input_size(None))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = [pool.submit(load_image, p, target_size) for p in paths[0:batch_size]]
+        for start in range(0, len(paths), batch_size):
+            batch = np.stack([future.result() for future in pending])
+            pending = [pool.submit(load_image, p, target_size) for p in paths[start + batch_size:start + 2 * batch_size]]
+            yield start, batch
+
+
+def extract_embeddings(model_path='model_trained_101class.hdf5', out_dir='food101/embeddings', batch_size=64):
+    import numpy as np
+    from tensorflow.keras.models import load_model
+    os.makedirs(out_dir, exist_ok=True)
+    extractor = embedding_model(load_model(model_path, compile=False))
+    for split, data_dir in (('train', dest_train), ('test', dest_test)):
+        path = os.path.join(out_dir, split + '_embeddings.npy')
+        if os.path.exists(path):
+            continue
+        paths, _, _ = list_image_files(data_dir, load_classes())
+        print("Embedding", len(paths), split, "images")
+        np.save(path + '.tmp.npy', embed_images(extractor, paths, batch_size))
+        os.replace(path + '.tmp.npy', path)
+        with open(os.path.join(out_dir, split + '_paths.txt'), 'w') as txt:
+            txt.write('\n'.join(paths) + '\n')
+    return Path(out_dir)
+
+
+def build_ivf_index(embeddings_path, index_dir, n_lists=256, iterations=10, sample_size=50000, seed=0):
+    import numpy as np
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    rng = np.random.RandomState(seed)
+    n_lists = min(n_lists, len(embeddings))
+    sample = np.asarray(embeddings[np.sort(rng.choice(len(embeddings), min(sample_size, len(embeddings)),
+                                                      replace=False))], dtype=np.float32)
+
+    # Spherical k-means on a sample
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(iterations):
+        assign = (sample @ centroids.T).argmax(axis=1)
+        for c in range(n_lists):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+
+    assign = np.concatenate([(np.asarray(embeddings[start:start + 65536], dtype=np.float32) @ centroids.T).argmax(axis=1)
+                             for start in range(0, len(embeddings), 65536)])
+    ids = np.argsort(assign, kind='stable').astype(np.int32)
+    offsets = np.searchsorted(assign[ids], np.arange(n_lists + 1)).astype(np.int64)
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, 'centroids.npy'), centroids.astype(np.float32))
+    np.save(os.path.join(index_dir, 'ids.npy'), ids)
+    np.save(os.path.join(index_dir, 'offsets.npy'), offsets)
+    # Vectors are stored in list order so every list is one contiguous read
+    np.save(os.path.join(index_dir, 'vectors.npy'), np.asarray(embeddings, dtype=np.float16)[ids])
+    print("Built an index of %d vectors in %d lists" % (len(ids), n_lists))
+    return Path(index_dir)
+
+
+class IVFIndex(object):
+    def __init__(self, index_dir):
+        import numpy as np
+        self.centroids = np.load(os.path.join(index_dir, 'centroids.npy'))
+        self.ids = np.load(os.path.join(index_dir, 'ids.npy'))
+        self.offsets = np.load(os.path.join(index_dir, 'offsets.npy'))
+        self.vectors = np.load(os.path.join(index_dir, 'vectors.npy'), mmap_mode='r')
+
+    # Returns (similarities, ids) of shape (len(queries), k), best first, -1 ids when fewer than k found
+    def search(self, queries, k=10, nprobe=8):
+        import numpy as np
+        queries = normalize_rows(np.asarray(queries, dtype=np.float32))
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+
+        # Scan each probed list once for all the queries that probe it
+        for l in np.unique(probe):
+            start, end = self.offsets[l], self.offsets[l + 1]
+            if start == end:
+                continue
+            q = np.nonzero((probe == l).any(axis=1))[0]
+            scores = queries[q] @ np.asarray(self.vectors[start:end], dtype=np.float32).T
+            scores = np.concatenate([best_scores[q], scores], axis=1)
+            candidates = np.concatenate([best_ids[q], np.broadcast_to(self.ids[start:end], (len(q), end - start))],
+                                        axis=1)
+            top = np.argsort(-scores, axis=1)[:, :k]
+            best_scores[q] = np.take_along_axis(scores, top, axis=1)
+            best_ids[q] = np.take_along_axis(candidates, top, axis=1)
+        return best_scores, best_ids
+
+
+# Nearest training images of each query image
+def find_similar(images, model_path='model_trained_101class.hdf5', index_dir='food101/embeddings/train_index',
+                 paths_file='food101/embeddings/train_paths.txt', k=5, nprobe=8, batch_size=64):
+    from tensorflow.keras.models import load_model
+    extractor = embedding_model(load_model(model_path, compile=False))
+    with open(paths_file) as txt:
+        indexed_paths = txt.read().splitlines()
+    scores, ids = IVFIndex(index_dir).search(embed_images(extractor, list(images), batch_size), k, nprobe)
+    return [(image, [(indexed_paths[i], float(s)) for s, i in zip(row_scores, row_ids) if i >= 0])
+            for image, row_scores, row_ids in zip(images, scores, ids)]
+
+
+# Test images whose nearest training image has a cosine similarity of at least threshold.
+# These near duplicates inflate the validation accuracy
+def find_duplicates(out_dir='food101/embeddings', threshold=0.95, nprobe=8, batch_size=4096):
+    import numpy as np
+    index = IVFIndex(os.path.join(out_dir, 'train_index'))
+    test = np.load(os.path.join(out_dir, 'test_embeddings.npy'), mmap_mode='r')
+    with open(os.path.join(out_dir, 'train_paths.txt')) as txt:
+        train_paths = txt.read().splitlines()
+    with open(os.path.join(out_dir, 'test_paths.txt')) as txt:
+        test_paths = txt.read().splitlines()
+
+    duplicates = []
+    for start in range(0, len(test), batch_size):
+        scores, ids = index.search(test[start:start + batch_size], k=1, nprobe=nprobe)
+        for i in np.nonzero(scores[:, 0] >= threshold)[0]:
+            duplicates.append((test_paths[start + i], train_paths[ids[i, 0]], float(scores[i, 0])))
+
+    with open(os.path.join(out_dir, 'duplicates.csv'), 'w') as csv:
+        csv.write('test_image,train_image,similarity\n')
+        for row in sorted(duplicates, key=lambda d: -d[2]):
+            csv.write('%s,%s,%.4f\n' % row)
+    print("%d of %d test images have a near duplicate in train (similarity >= %.2f)" % (
+        len(duplicates), len(test), threshold))
+    return duplicates
+
+
+# Local HTTP inference server
+# The model is loaded and warmed up once. Request threads decode the uploaded image and
+# hand it to a single MicroBatcher thread, which groups concurrent requests into one
+# predict call of at most max_batch_size images, waiting at most max_wait_ms for a batch to fill
+#   POST /predict   body: image bytes  ->  {"labels": [...], "scores": [...]}
+#   GET  /metrics   latency percentiles, throughput and batch statistics
+import io
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+def decode_image_bytes(data, target_size=(299, 299)):
+    import numpy as np
+    from PIL import Image
+    # Nearest resize, the same as image.load_img
+    img = Image.open(io.BytesIO(data)).convert('RGB').resize((target_size[1], target_size[0]), Image.NEAREST)
+    return np.asarray(img, dtype=np.float32) / 255.
+
+
+class LatencyStats(object):
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.started = time.time()
+
+    def record_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(len(latencies))
+            self.requests += len(latencies)
+
+    def snapshot(self):
+        import numpy as np
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            batch_sizes = np.array(self.batch_sizes)
+            requests = self.requests
+        uptime = time.time() - self.started
+        return {
+            'requests': requests,
+            'uptime_sec': uptime,
+            'throughput_rps': requests / uptime if uptime else 0.,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else None,
+        }
+
+
+class MicroBatcher(object):
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5, top_k=5, target_size=None, labels=None,
+                 calibration=None):
+        import numpy as np
+        self.model = model
+        self.calibration = calibration
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.labels = labels if labels is not None else model_classes()
+        self.top_k = min(top_k, len(self.labels))
+        self.target_size = tuple(target_size or model_input_size(model))
+        self.stats = LatencyStats()
+        self.requests = queue.Queue()
+        # Batches are always padded to max_batch_size so predict never sees a new shape
+        self.batch = np.zeros((max_batch_size,) + self.target_size + (3,), dtype=np.float32)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def warm_up(self):
+        self.model.predict(self.batch, batch_size=self.max_batch_size)
+
+    def start(self):
+        self.warm_up()
+        self.thread.start()
+        return self
+
+    def submit(self, img):
+        future = Future()
+        self.requests.put((img, future, time.perf_counter()))
+        return future
+
+    def run(self):
+        import numpy as np
+        while True:
+            pending = [self.requests.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            for i, (img, _, _) in enumerate(pending):
+                self.batch[i] = img
+            try:
+                preds = self.model.predict(self.batch, batch_size=self.max_batch_size)[:len(pending)]
+            except Exception as e:
+                for _, future, _ in pending:
+                    future.set_exception(e)
+                continue
+
+            if self.calibration is not None:
+                preds = apply_temperature(preds, self.calibration['temperature'])
+            top = np.argsort(-preds, axis=1)[:, :self.top_k]
+            done = time.perf_counter()
+            for (_, future, received), pred, indices in zip(pending, preds, top):
+                if self.calibration is not None and pred[indices[0]] < self.calibration['threshold']:
+                    indices = indices[:1]
+                    labels = [NO_CLASS]
+                else:
+                    labels = [self.labels[i] for i in indices]
+                future.set_result({'labels': labels, 'scores': [float(p) for p in pred[indices]]})
+            self.stats.record_batch([done - received for _, _, received in pending])
+
+
+def make_handler(batcher):
+    class PredictHandler(BaseHTTPRequestHandler):
+        def send_json(self, obj, status=200):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(batcher.stats.snapshot())
+            elif self.path == '/health':
+                self.send_json({'status': 'ok'})
+            else:
+                self.send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json({'error': 'not found'}, 404)
+                return
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                img = decode_image_bytes(data, batcher.target_size)
+            except Exception as e:
+                self.send_json({'error': 'cannot decode image: %s' % e}, 400)
+                return
+            try:
+                self.send_json(batcher.submit(img).result())
+            except Exception as e:
+                self.send_json({'error': str(e)}, 500)
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictHandler
+
+
+def serve(model_path='model_trained_101class.hdf5', host='127.0.0.1', port=8080, max_batch_size=32, max_wait_ms=5,
+          top_k=5, reject=False):
+    from tensorflow.keras.models import load_model
+    calibration = load_calibration(model_path) if reject else None
+    model = load_model(model_path, compile=False)
+    batcher = MicroBatcher(model, max_batch_size, max_wait_ms, top_k, calibration=calibration).start()
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print("Serving %s on http://%s:%d" % (model_path, host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# Post-training INT8 quantization
+# export_tflite_int8 writes a fully integer TFLite model (uint8 input and output), calibrated
+# on a random sample of dataset/train. TFLitePredictor runs it with the TFLite interpreter and
+# has the same predict() as a Keras model, so it plugs into predict_batch and the server
+def export_tflite_int8(model_path='model_trained_101class.hdf5', out_path='model_int8_101class.tflite',
+                       calibration_samples=500, img_size=None, seed=0):
+    import numpy as np
+    import tensorflow as tf
+    from tensorflow.keras.models import Model, load_model
+    model = load_model(model_path, compile=False)
+    img_size = tuple(img_size or model_input_size(model))
+    inputs = tf.keras.Input(shape=tuple(img_size) + (3,))
+    fixed = Model(inputs=inputs, outputs=model(inputs))
+
+    paths, _, _ = list_image_files(dest_train)
+    sample = random.Random(seed).sample(paths, min(calibration_samples, len(paths)))
+
+    def representative_dataset():
+        for p in sample:
+            yield [load_image(p, img_size)[np.newaxis]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(fixed)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.uint8
+    converter.inference_output_type = tf.uint8
+    with open(out_path, 'wb') as f:
+        f.write(converter.convert())
+    print("Saved", out_path)
+    return out_path
+
+
+class TFLitePredictor(object):
+    def __init__(self, model_path='model_int8_101class.tflite', num_threads=None, batch_size=32):
+        import tensorflow as tf
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = batch_size
+        self.interpreter.resize_tensor_input(self.input['index'], [batch_size] + list(self.input['shape'][1:]))
+        self.interpreter.allocate_tensors()
+        self.input_shape = (None,) + tuple(int(d) for d in self.input['shape'][1:])
+
+    # Takes float images scaled to [0, 1] like the Keras model
+    def predict(self, x, batch_size=None, verbose=0):
+        import numpy as np
+        in_scale, in_zero = self.input['quantization']
+        out_scale, out_zero = self.output['quantization']
+        dtype = self.input['dtype']
+        limits = np.iinfo(dtype)
+
+        preds = []
+        for start in range(0, len(x), self.batch_size):
+            chunk = x[start:start + self.batch_size]
+            q = np.zeros((self.batch_size,) + chunk.shape[1:], dtype=dtype)
+            q[:len(chunk)] = np.clip(np.round(chunk / in_scale + in_zero), limits.min, limits.max)
+            self.interpreter.set_tensor(self.input['index'], q)
+            self.interpreter.invoke()
+            out = self.interpreter.get_tensor(self.output['index'])[:len(chunk)]
+            preds.append((out.astype(np.float32) - out_zero) * out_scale)
+        return np.concatenate(preds)
+
+
+# Top-1/top-5 accuracy and images/sec (decode included) of any model with a predict() method
+def evaluate_topk(model, data_dir=dest_test, batch_size=32, max_images=None, seed=0, tta_views=1):
+    start = time.perf_counter()
+    metrics = stream_evaluation(model, data_dir, batch_size, max_images=max_images, seed=seed, tta_views=tta_views)
+    elapsed = time.perf_counter() - start
+    return {'images': metrics.count, 'top1': metrics.top1_accuracy, 'top5': metrics.top5_accuracy,
+            'images_per_sec': metrics.count / elapsed}
+
+
+def compare_tflite(model_path='model_trained_101class.hdf5', tflite_path='model_int8_101class.tflite',
+                   num_threads=None, batch_size=32, max_images=None):
+    from tensorflow.keras.models import load_model
+    report = {
+        'float32': evaluate_topk(load_model(model_path, compile=False), batch_size=batch_size, max_images=max_images),
+        'int8': evaluate_topk(TFLitePredictor(tflite_path, num_threads, batch_size), batch_size=batch_size,
+                              max_images=max_images),
+    }
+    for name, r in report.items():
+        print("%-8s top-1 %.4f  top-5 %.4f  %.1f images/sec" % (name, r['top1'], r['top5'], r['images_per_sec']))
+    return report
+
+
+# Full test set evaluation
+# Streams every test image through the model in large batches (decode runs on a thread pool),
+# keeping only a running top-5 count and the confusion matrix, so memory does not grow with
+# the number of images. The test set can be split over worker processes: each shard writes
+# <out_dir>/shard_<i>_of_<n>.npz and merge_evaluations() sums them into the final report
+class StreamingMetrics(object):
+    def __init__(self, n_classes, class_names=None):
+        import numpy as np
+        self.confusion = np.zeros((n_classes, n_classes), dtype=np.int64)
+        self.top5 = 0
+        self.class_names = class_names
+
+    @property
+    def count(self):
+        return int(self.confusion.sum())
+
+    @property
+    def top1_accuracy(self):
+        return float(self.confusion.trace()) / max(self.count, 1)
+
+    @property
+    def top5_accuracy(self):
+        return float(self.top5) / max(self.count, 1)
+
+    def update(self, labels, top_indices):
+        import numpy as np
+        labels, top_indices = np.asarray(labels), np.asarray(top_indices)
+        np.add.at(self.confusion, (labels, top_indices[:, 0]), 1)
+        self.top5 += int((top_indices[:, :5] == labels[:, np.newaxis]).any(axis=1).sum())
+
+    def merge(self, other):
+        self.confusion += other.confusion
+        self.top5 += other.top5
+        return self
+
+    def save(self, path):
+        import numpy as np
+        np.savez(path, confusion=self.confusion, top5=self.top5, class_names=np.array(self.class_names or []))
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        data = np.load(path)
+        class_names = [str(food) for food in data['class_names']] if 'class_names' in data.files else []
+        metrics = cls(len(data['confusion']), class_names or None)
+        metrics.confusion[:] = data['confusion']
+        metrics.top5 = int(data['top5'])
+        return metrics
+
+
+def write_evaluation_report(metrics, class_names, out_dir):
+    import numpy as np
+    confusion = metrics.confusion
+    support = confusion.sum(axis=1)
+    predicted = confusion.sum(axis=0)
+    correct = np.diag(confusion)
+    off_diagonal = confusion - np.diag(correct)
+
+    with open(os.path.join(out_dir, 'per_class.csv'), 'w') as csv:
+        csv.write('class,support,accuracy,precision,f1,most_confused_with,confused_count\n')
+        for i, food in enumerate(class_names):
+            recall = correct[i] / support[i] if support[i] else 0.
+            precision = correct[i] / predicted[i] if predicted[i] else 0.
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.
+            other = int(off_diagonal[i].argmax())
+            csv.write('%s,%d,%.4f,%.4f,%.4f,%s,%d\n' % (food, support[i], recall, precision, f1,
+                                                      class_names[other], off_diagonal[i, other]))
+    np.save(os.path.join(out_dir, 'confusion.npy'), confusion)
+    summary = {'images': metrics.count, 'top1': metrics.top1_accuracy, 'top5': metrics.top5_accuracy}
+    write_json_atomic(summary, os.path.join(out_dir, 'summary.json'))
+    print("Evaluated %d images: top-1 %.4f, top-5 %.4f" % (summary['images'], summary['top1'], summary['top5']))
+    return summary
+
+
+# Runs the images of data_dir through the model into a StreamingMetrics, the one evaluation
+# path behind evaluate() and evaluate_topk(). max_images draws a seeded sample first, then
+# the shard takes every num_shards-th image of it
+def stream_evaluation(model, data_dir=dest_test, batch_size=128, max_images=None, seed=0, num_shards=1, shard_index=0,
+                      workers=8, tta_views=1, log_every=None):
+    # Ground truth in the sorted folder order the model was trained with
+    paths, labels, class_names = list_image_files(data_dir)
+    if max_images is not None and max_images < len(paths):
+        keep = sorted(random.Random(seed).sample(range(len(paths)), max_images))
+        paths, labels = [paths[i] for i in keep], [labels[i] for i in keep]
+    paths, labels = paths[shard_index::num_shards], labels[shard_index::num_shards]
+
+    # The predicted "labels" are the class indices themselves
+    metrics = StreamingMetrics(len(class_names), class_names)
+    results = iter_predict_batches(model, paths, batch_size, top_k=5, workers=workers,
+                                   labels=list(range(len(class_names))), tta_views=tta_views)
+    batch_labels, batch_top = [], []
+    for i, ((_, top, _), label) in enumerate(zip(results, labels)):
+        batch_labels.append(label)
+        batch_top.append(top)
+        if len(batch_labels) == batch_size or i == len(paths) - 1:
+            metrics.update(batch_labels, batch_top)
+            batch_labels, batch_top = [], []
+            if log_every and ((i + 1) // batch_size % log_every == 0 or i == len(paths) - 1):
+                print("%d/%d images, top-1 %.4f, top-5 %.4f" % (
+                    i + 1, len(paths), metrics.top1_accuracy, metrics.top5_accuracy))
+    return metrics
+
+
+def evaluate(model_path='model_trained_101class.hdf5', data_dir=dest_test, out_dir='food101/eval', batch_size=128,
+             num_shards=1, shard_index=0, workers=8, tta_views=1, threads=None, log_every=20):
+    import tensorflow as tf
+    from tensorflow.keras.models import load_model
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+    os.makedirs(out_dir, exist_ok=True)
+
+    model = load_model(model_path, compile=False)
+    metrics = stream_evaluation(model, data_dir, batch_size, num_shards=num_shards, shard_index=shard_index,
+                                workers=workers, tta_views=tta_views, log_every=log_every)
+
+    if num_shards > 1:
+        path = os.path.join(out_dir, 'shard_%d_of_%d.npz' % (shard_index, num_shards))
+        metrics.save(path)
+        print("Saved", path)
+        return metrics
+    write_evaluation_report(metrics, metrics.class_names, out_dir)
+    return metrics
+
+
+def merge_evaluations(out_dir='food101/eval'):
+    shards = sorted(Path(out_dir).glob('shard_*_of_*.npz'))
+    if not shards:
+        raise ValueError("No shard results in %s" % out_dir)
+    expected = int(shards[0].stem.split('_of_')[1])
+    if len(shards) != expected:
+        raise ValueError("Found %d of %d shards in %s" % (len(shards), expected, out_dir))
+    metrics = StreamingMetrics.load(str(shards[0]))
+    for path in shards[1:]:
+        metrics.merge(StreamingMetrics.load(str(path)))
+    write_evaluation_report(metrics, metrics.class_names or model_classes(), out_dir)
+    return metrics
+
+
+# Runs one evaluate shard per local worker process, then merges them
+def evaluate_parallel(num_workers=2, out_dir='food101/eval', **kwargs):
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    workers = []
+    for i in range(num_workers):
+        kwargs_i = dict(kwargs, out_dir=out_dir, num_shards=num_workers, shard_index=i, threads=threads)
+        code = 'import json, my_food101; my_food101.evaluate(**json.loads(%r))' % json.dumps(kwargs_i)
+        workers.append(subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__))))
+    wait_for_workers(workers, 'evaluation worker')
+    return merge_evaluations(out_dir)
+
+
+# Accuracy gain against throughput loss of TTA on dataset/test, one row per number of views
+def tta_report(model_path='model_trained_101class.hdf5', views=(1, 2, 4, 6, 12), batch_size=16, max_images=None):
+    from tensorflow.keras.models import load_model
+    model = load_model(model_path, compile=False)
+    report = {}
+    for n_views in views:
+        report[n_views] = evaluate_topk(model, batch_size=batch_size, max_images=max_images, tta_views=n_views)
+
+    base = report[views[0]]
+    print("%6s %8s %8s %10s %12s %10s" % ('views', 'top-1', 'top-5', 'gain', 'images/sec', 'slowdown'))
+    for n_views, r in report.items():
+        print("%6d %8.4f %8.4f %+10.4f %12.1f %9.2fx" % (
+            n_views, r['top1'], r['top5'], r['top1'] - base['top1'], r['images_per_sec'],
+            base['images_per_sec'] / r['images_per_sec']))
+    return report
+
+
+# Benchmark suite for the data, training and inference hot paths
+# Runs on a small synthetic dataset with the Food-101 layout (images/<class>/<id>.jpg,
+# meta/train.txt, meta/test.txt) generated locally with a fixed seed, and writes the
+# results to bench/<commit>.json so runs can be compared between commits
+import platform
+import resource
+import tempfile
+
+def make_synthetic_dataset(root, n_classes=4, train_per_class=32, test_per_class=8, img_size=(512, 384), seed=0):
+    import numpy as np
+    from PIL import Image
+    rng = np.random.RandomState(seed)
+    width, height = img_size
+    os.makedirs(os.path.join(root, 'meta'), exist_ok=True)
+    splits = {'train': [], 'test': []}
+    for c in range(n_classes):
+        food = 'food_%03d' % c
+        os.makedirs(os.path.join(root, 'images', food), exist_ok=True)
+        for i in range(train_per_class + test_per_class):
+            # Upsampled noise compresses like a photo rather than like pure noise
+            small = rng.randint(0, 256, size=(height // 16, width // 16, 3)).astype(np.uint8)
+            img = Image.fromarray(small).resize((width, height), Image.BILINEAR)
+            img.save(os.path.join(root, 'images', food, '%d.jpg' % i), quality=90)
+            splits['train' if i < train_per_class else 'test'].append('%s/%d' % (food, i))
+    for split, lines in splits.items():
+        with open(os.path.join(root, 'meta', split + '.txt'), 'w') as txt:
+            txt.write('\n'.join(lines) + '\n')
+    return Path(root)
+
+
+def latency_percentiles(seconds):
+    import numpy as np
+    ms = np.array(seconds) * 1000.
+    return {'p50_ms': float(np.percentile(ms, 50)), 'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)), 'mean_ms': float(ms.mean())}
+
+
+# Latency of the model call alone on random images, after a warm-up call for the shape
+def inference_latency(model, batch_size=1, img_size=(299, 299), repeats=30, seed=0):
+    import numpy as np
+    x = np.random.RandomState(seed).rand(batch_size, img_size[0], img_size[1], 3).astype(np.float32)
+    model.predict_on_batch(x)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict_on_batch(x)
+        times.append(time.perf_counter() - start)
+    return dict(latency_percentiles(times), batch_size=batch_size, images_per_sec=batch_size * repeats / sum(times))
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run_benchmarks(out_path=None, root=None, batch_size=16, train_steps=10, data_batches=20, latency_repeats=30,
+                   infer_batch_size=32, img_size=(299, 299), seed=0):
+    import tensorflow as tf
+    from tensorflow.keras.optimizers import SGD
+
+    tf.random.set_seed(seed)
+    root = root or tempfile.mkdtemp(prefix='food101_bench_')
+    src = os.path.join(root, 'synthetic')
+    if not os.path.isdir(os.path.join(src, 'images')):
+        make_synthetic_dataset(src, seed=seed)
+    train_dir, test_dir = os.path.join(root, 'train'), os.path.join(root, 'test')
+    results = {}
+
+    # prepare_data copy rate, from scratch
+    for d in (train_dir, test_dir):
+        shutil.rmtree(d, ignore_errors=True)
+    start = time.perf_counter()
+    prepare_data(os.path.join(src, 'meta', 'train.txt'), os.path.join(src, 'images'), train_dir)
+    elapsed = time.perf_counter() - start
+    prepare_data(os.path.join(src, 'meta', 'test.txt'), os.path.join(src, 'images'), test_dir)
+    manifest = read_manifest(train_dir)
+    files = sum(len(images) for images in manifest.values())
+    size = sum(entry[0] for images in manifest.values() for entry in images.values())
+    results['prepare'] = {'files_per_sec': files / elapsed, 'mb_per_sec': size / elapsed / 2 ** 20}
+
+    # Input pipeline, decode only and decode + augment
+    for name, augment in (('decode', False), ('decode_augment', True)):
+        ds, nb_samples, _ = make_dataset(train_dir, batch_size=batch_size, img_size=img_size, augment=augment)
+        ds = ds.repeat()
+        iterator = iter(ds)
+        next(iterator)
+        start = time.perf_counter()
+        for _ in range(data_batches):
+            next(iterator)
+        results[name] = {'images_per_sec': data_batches * batch_size / (time.perf_counter() - start)}
+
+    # Train steps
+    ds, nb_samples, class_names = make_dataset(train_dir, batch_size=batch_size, training=True, img_size=img_size,
+                                               seed=seed)
+    model = build_model(len(class_names), weights=None)
+    model.compile(optimizer=SGD(learning_rate=0.0001, momentum=0.9), loss='categorical_crossentropy')
+    throughput = make_throughput_logger(batch_size)
+    model.fit(ds, steps_per_epoch=train_steps + 1, epochs=1, verbose=0, callbacks=[throughput])
+    results['train'] = {'steps_per_sec': throughput.images_per_sec[-1] / batch_size,
+                        'images_per_sec': throughput.images_per_sec[-1]}
+
+    # Inference, model call only
+    results['inference_single'] = inference_latency(model, 1, img_size, latency_repeats, seed)
+    results['inference_batch'] = inference_latency(model, infer_batch_size, img_size, latency_repeats, seed)
+
+    # End to end predict_batch, decode included
+    paths, _, _ = list_image_files(test_dir)
+    start = time.perf_counter()
+    predict_batch(model, paths, infer_batch_size, labels=class_names)
+    results['predict_batch'] = {'images_per_sec': len(paths) / (time.perf_counter() - start)}
+
+    results['startup'] = measure_startup()
+    results['peak_rss_mb'] = peak_rss_mb()
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'tensorflow': tf.__version__,
+        'cpu_count': os.cpu_count(),
+        'config': {'batch_size': batch_size, 'train_steps': train_steps, 'data_batches': data_batches,
+                   'latency_repeats': latency_repeats, 'infer_batch_size': infer_batch_size,
+                   'img_size': list(img_size), 'seed': seed},
+        'results': results,
+    }
+
+    if out_path is None:
+        out_path = os.path.join('bench', '%s.json' % (report['commit'] or 'results'))
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    with open(out_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print("Saved", out_path)
+    return report
+
+
+# Prints every metric of two benchmark JSON files side by side with the ratio new/old
+def compare_benchmarks(old_path, new_path):
+    def flatten(results, prefix=''):
+        flat = {}
+        for key, value in results.items():
+            if isinstance(value, dict):
+                flat.update(flatten(value, prefix + key + '.'))
+            elif isinstance(value, (int, float)):
+                flat[prefix + key] = value
+        return flat
+
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_results, new_results = flatten(old['results']), flatten(new['results'])
+    print("%-36s %12s %12s %8s" % ('metric', old.get('commit', 'old'), new.get('commit', 'new'), 'ratio'))
+    for key in sorted(set(old_results) & set(new_results)):
+        ratio = new_results[key] / old_results[key] if old_results[key] else float('nan')
+        print("%-36s %12.2f %12.2f %8.2f" % (key, old_results[key], new_results[key], ratio))
+
+
+# Startup time of the module and of the CLI, measured in fresh interpreters.
+# Also reports which heavy dependencies got imported, which should be none
+HEAVY_MODULES = ('tensorflow', 'keras', 'matplotlib', 'numpy', 'PIL')
+
+def measure_startup(repeats=5):
+    import statistics
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    code = ('import sys, time; start = time.perf_counter(); import my_food101; '
+            'print(time.perf_counter() - start); print(",".join(m for m in %r if m in sys.modules))' % (HEAVY_MODULES,))
+
+    import_times, cli_times = [], []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', code], cwd=module_dir, stdout=subprocess.PIPE,
+                             universal_newlines=True, check=True).stdout.split('\n')
+        import_times.append(float(out[0]))
+        loaded = [m for m in out[1].split(',') if m]
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(module_dir, 'my_food101.py'), '--help'], cwd=module_dir,
+                       stdout=subprocess.DEVNULL, check=True)
+        cli_times.append(time.perf_counter() - start)
+
+    result = {'import_sec': statistics.median(import_times),
+              'cli_help_sec': statistics.median(cli_times),
+              'heavy_modules_loaded': loaded}
+    print("import my_food101: %.3fs, my_food101.py --help: %.3fs (median of %d)" % (
+        result['import_sec'], result['cli_help_sec'], repeats))
+    if loaded:
+        print("WARNING: importing my_food101 loads", ", ".join(loaded))
+    return result
+
+
+# Knowledge distillation into a compact student for CPU serving
+# The trained InceptionV3 (teacher) runs once over dataset/train and dataset/test and its
+# outputs are cached as float16 log-probabilities:
+#   <teacher_dir>/{train,test}_logprobs.npy   (images, classes)
+#   <teacher_dir>/{train,test}_paths.txt      image of every row, the cache is rebuilt when it changes
+# Log-probabilities divided by T soften exactly like logits divided by T, softmax ignores the
+# per-row constant between them. The student is MobileNetV2 at 224x224 with the same head,
+# trained on alpha * cross-entropy with the true label + (1 - alpha) * T^2 * KL(teacher || student)
+STUDENT_MODEL = 'model_student_101class.hdf5'
+
+
+def cache_teacher_logprobs(teacher_path='model_trained_101class.hdf5', teacher_dir='food101/teacher', batch_size=64):
+    import numpy as np
+    from numpy.lib.format import open_memmap
+    from tensorflow.keras.models import load_model
+    os.makedirs(teacher_dir, exist_ok=True)
+    teacher, class_names, cached = None, None, {}
+    for split, data_dir in (('train', dest_train), ('test', dest_test)):
+        paths, labels, class_names = list_image_files(data_dir, class_names)
+        out_path = os.path.join(teacher_dir, split + '_logprobs.npy')
+        paths_path = os.path.join(teacher_dir, split + '_paths.txt')
+        if os.path.exists(out_path) and os.path.exists(paths_path):
+            with open(paths_path) as f:
+                if f.read().splitlines() == paths:
+                    cached[split] = (paths, labels, np.load(out_path))
+                    continue
+
+        if teacher is None:
+            teacher = load_model(teacher_path, compile=False)
+        print("Caching teacher outputs for", len(paths), split, "images")
+        ds, _, _ = make_dataset(data_dir, batch_size=batch_size, class_names=class_names)
+        tmp = out_path + '.tmp.npy'
+        out = open_memmap(tmp, mode='w+', dtype=np.float16, shape=(len(paths), len(class_names)))
+        start = 0
+        for imgs, _ in ds:
+            probs = teacher.predict_on_batch(imgs)
+            out[start:start + len(probs)] = np.log(np.maximum(probs, 1e-30))
+            start += len(probs)
+        out.flush()
+        del out
+        os.replace(tmp, out_path)
+        with open(paths_path, 'w') as txt:
+            txt.write('\n'.join(paths) + '\n')
+        cached[split] = (paths, labels, np.load(out_path))
+    return cached, class_names
+
+
+def build_student(n_classes, img_size=(224, 224), weights='imagenet', width=1.0):
+    from tensorflow.keras.applications.mobilenet_v2 import MobileNetV2
+    from tensorflow.keras.layers import GlobalAveragePooling2D, Input, Rescaling
+    from tensorflow.keras.models import Model
+    inputs = Input(shape=tuple(img_size) + (3,))
+    # Images are scaled to [0, 1] everywhere in this file, MobileNetV2 expects [-1, 1]
+    x = Rescaling(2., offset=-1., name='to_mobilenet_range')(inputs)
+    mobilenet = MobileNetV2(input_tensor=x, include_top=False, weights=weights, alpha=width)
+    x = GlobalAveragePooling2D(name='avg_pool')(mobilenet.output)
+    return Model(inputs=inputs, outputs=build_head(x, n_classes))
+
+
+# y_true is the one-hot label followed by the teacher log-probabilities, y_pred the student softmax
+def distillation_loss(n_classes, alpha=0.1, temperature=4.):
+    import tensorflow as tf
+
+    def loss(y_true, y_pred):
+        hard, teacher = y_true[:, :n_classes], y_true[:, n_classes:] / temperature
+        student = tf.math.log(tf.clip_by_value(y_pred, 1e-12, 1.))
+        cross_entropy = -tf.reduce_sum(hard * student, axis=-1)
+        kl = tf.reduce_sum(tf.nn.softmax(teacher) * (tf.nn.log_softmax(teacher) -
+                                                     tf.nn.log_softmax(student / temperature)), axis=-1)
+        return alpha * cross_entropy + (1. - alpha) * temperature ** 2 * kl
+
+    return loss
+
+
+def distillation_training(teacher_path='model_trained_101class.hdf5', student_path=STUDENT_MODEL,
+                          teacher_dir='food101/teacher', img_size=(224, 224), epochs=10, batch_size=32, lr=0.001,
+                          alpha=0.1, temperature=4., fast=False, num_parallel_calls=AUTOTUNE, seed=0):
+    import tensorflow as tf
+    import tensorflow.keras.backend as K
+    from tensorflow.keras.callbacks import CSVLogger
+    from tensorflow.keras.optimizers import SGD
+    cached, class_names = cache_teacher_logprobs(teacher_path, teacher_dir)
+    n_classes = len(class_names)
+    K.clear_session()
+    set_precision(fast)
+
+    def make_split(split):
+        paths, labels, teacher = cached[split]
+        training = split == 'train'
+        ds = tf.data.Dataset.from_tensor_slices((paths, labels, teacher))
+        if training:
+            ds = ds.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True).repeat()
+
+        def load(index, example):
+            path, label, logprobs = example
+            img = tf.cast(decode_and_resize(path, img_size), tf.float32)
+            if training:
+                img = augment_image(img, augment_seed(seed, index))
+            return img / 255., tf.concat([tf.one_hot(label, n_classes), tf.cast(logprobs, tf.float32)], axis=0)
+
+        ds = ds.enumerate().map(load, num_parallel_calls=num_parallel_calls)
+        return ds.batch(batch_size, drop_remainder=training).prefetch(AUTOTUNE), len(paths)
+
+    def accuracy(y_true, y_pred):
+        return tf.keras.metrics.categorical_accuracy(y_true[:, :n_classes], y_pred)
+
+    train_ds, nb_train_samples = make_split('train')
+    validation_ds, nb_validation_samples = make_split('test')
+    student = build_student(n_classes, img_size)
+    student.compile(optimizer=SGD(learning_rate=lr, momentum=0.9),
+                    loss=distillation_loss(n_classes, alpha, temperature), metrics=[accuracy], jit_compile=fast)
+    student.fit(train_ds,
+                steps_per_epoch=nb_train_samples // batch_size,
+                validation_data=validation_ds,
+                validation_steps=nb_validation_samples // batch_size,
+                epochs=epochs,
+                callbacks=[make_throughput_logger(batch_size), CSVLogger('food101/student_history.log')])
+    student.save(student_path, include_optimizer=False)
+    return student
+
+
+# Model size, latency and peak memory of one model, loaded in this process
+def profile_inference(model_path, batch_size=32, repeats=30):
+    from tensorflow.keras.models import load_model
+    model = load_model(model_path, compile=False)
+    img_size = model_input_size(model)
+    return {'img_size': list(img_size),
+            'params': int(model.count_params()),
+            'file_mb': os.path.getsize(model_path) / 2. ** 20,
+            'inference_single': inference_latency(model, 1, img_size, repeats),
+            'inference_batch': inference_latency(model, batch_size, img_size, repeats),
+            'peak_rss_mb': peak_rss_mb()}
+
+
+# Accuracy on the same test images, then latency and memory with each model in a fresh
+# interpreter so that the peak RSS of one does not include the other
+def compare_student(teacher_path='model_trained_101class.hdf5', student_path=STUDENT_MODEL, max_images=2000,
+                    batch_size=32, repeats=30, out_path='food101/distillation.json'):
+    from tensorflow.keras.models import load_model
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    report = {}
+    for name, path in (('teacher', teacher_path), ('student', student_path)):
+        report[name] = evaluate_topk(load_model(path, compile=False), batch_size=batch_size, max_images=max_images)
+        code = 'import json, my_food101; print(json.dumps(my_food101.profile_inference(*json.loads(%r))))' % (
+            json.dumps([os.path.abspath(path), batch_size, repeats]))
+        out = subprocess.run([sys.executable, '-c', code], cwd=module_dir, stdout=subprocess.PIPE,
+                             universal_newlines=True, check=True).stdout
+        report[name].update(json.loads(out.strip().split('\n')[-1]))
+
+    print("%-8s %7s %7s %9s %8s %12s %12s %9s" % ('model', 'top-1', 'top-5', 'params', 'file MB', 'single p50 ms',
+                                                  'batch img/s', 'peak MB'))
+    for name, r in report.items():
+        print("%-8s %7.4f %7.4f %8.1fM %8.1f %12.1f %12.1f %9.0f" % (
+            name, r['top1'], r['top5'], r['params'] / 1e6, r['file_mb'], r['inference_single']['p50_ms'],
+            r['inference_batch']['images_per_sec'], r['peak_rss_mb']))
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    write_json_atomic(report, out_path)
+    return report
+
+
+# Command line interface
+#   python my_food101.py prepare food101/meta/train.txt food101/images dataset/train --mode hardlink
+#   python my_food101.py train --fast
+#   python my_food101.py predict pizza.jpg lasagna.jpg
+#   python my_food101.py distill --epochs 10
+#   python my_food101.py benchmark --startup
+import argparse
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Food-101 classification with InceptionV3')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('prepare', help='split the images into train/test folders')
+    p.add_argument('filepath', help='meta/train.txt or meta/test.txt')
+    p.add_argument('src', help='food-101 images folder')
+    p.add_argument('dest', help='destination folder')
+    p.add_argument('--mode', default='copy', choices=['copy', 'hardlink', 'symlink', 'reflink'])
+    p.add_argument('--workers', type=int, default=16)
+    p.add_argument('--verify', action='store_true', help='only report missing or corrupt files')
+    p.add_argument('--repair', action='store_true', help='place missing or corrupt files again')
+
+    p = commands.add_parser('cache', help='build the pre-decoded image cache')
+    p.add_argument('--cache-dir', default='dataset_cache')
+    p.add_argument('--workers', type=int, default=8)
+
+    p = commands.add_parser('train', help='train the model')
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--cache-dir', default=None, help='train from the pre-decoded image cache')
+    p.add_argument('--fast', action='store_true', help='bfloat16 mixed precision and XLA')
+    p.add_argument('--workers', type=int, default=1, help='number of local data-parallel worker processes')
+    p.add_argument('--resumable', action='store_true', help='custom loop with step checkpoints')
+    p.add_argument('--checkpoint-dir', default='food101/checkpoints')
+    p.add_argument('--save-every', type=int, default=500)
+    p.add_argument('--check-resume', action='store_true',
+                   help='kill and restart a small resumable run on synthetic data and check that it resumes')
+    p.add_argument('--curriculum', nargs='?', const='160:11:2,224:51:2,299:all:3', default=None,
+                   metavar='SIZE:CLASSES:EPOCHS,...',
+                   help='progressive resolution and class-subset stages (default %(const)s)')
+    p.add_argument('--profile-log', default=None, help='write per-step timings as JSON lines to this file')
+    p.add_argument('--stall-threshold', type=float, default=0.2,
+                   help='warn when this fraction of step time is spent waiting for input')
+
+    p = commands.add_parser('predict', help='predict the class of images')
+    p.add_argument('images', nargs='+')
+    p.add_argument('--model', default='model_trained_101class.hdf5')
+    p.add_argument('--tflite', default=None, help='use an INT8 TFLite model instead')
+    p.add_argument('--threads', type=int, default=None)
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--top-k', type=int, default=5)
+    p.add_argument('--tta', type=int, default=1, help='number of test-time augmentation views (1-12)')
+    p.add_argument('--reject', action='store_true', help='answer NO-CLASS below the calibrated threshold')
+
+    p = commands.add_parser('calibrate', help='fit the temperature and NO-CLASS threshold on held-out images')
+    p.add_argument('--model', default='model_trained_101class.hdf5')
+    p.add_argument('--data-dir', default=dest_test)
+    p.add_argument('--max-images', type=int, default=5000)
+    p.add_argument('--target-recall', type=float, default=0.95,
+                   help='fraction of correctly classified images kept above the threshold')
+
+    p = commands.add_parser('tta-report', help='TTA accuracy against throughput on dataset/test')
+    p.add_argument('--model', default='model_trained_101class.hdf5')
+    p.add_argument('--views', type=int, nargs='+', default=[1, 2, 4, 6, 12])
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--max-images', type=int, default=None)
+
+    p = commands.add_parser('evaluate', help='evaluate on the whole test set with a per-class report')
+    p.add_argument('--model', default='model_trained_101class.hdf5')
+    p.add_argument('--data-dir', default=dest_test)
+    p.add_argument('--out-dir', default='food101/eval')
+    p.add_argument('--batch-size', type=int, default=128)
+    p.add_argument('--tta', type=int, default=1)
+    p.add_argument('--workers', type=int, default=1, help='number of local worker processes, one shard each')
+    p.add_argument('--num-shards', type=int, default=1, help='evaluate only one shard of the test set')
+    p.add_argument('--shard', type=int, default=0)
+    p.add_argument('--merge', action='store_true', help='merge the shard results in --out-dir')
+
+    p = commands.add_parser('embed', help='extract train/test embeddings and index the train set')
+    p.add_argument('--model', default='model_trained_101class.hdf5')
+    p.add_argument('--out-dir', default='food101/embeddings')
+    p.add_argument('--lists', type=int, default=256, help='number of IVF lists')
+
+    p = commands.add_parser('similar', help='find the most similar training images')
+    p.add_argument('images', nargs='+')
+    p.add_argument('--model', default='model_trained_101class.hdf5')
+    p.add_argument('--out-dir', default='food101/embeddings')
+    p.add_argument('--top-k', type=int, default=5)
+    p.add_argument('--nprobe', type=int, default=8)
+
+    p = commands.add_parser('duplicates', help='find near-duplicate images between test and train')
+    p.add_argument('--out-dir', default='food101/embeddings')
+    p.add_argument('--threshold', type=float, default=0.95)
+    p.add_argument('--nprobe', type=int, default=8)
+
+    p = commands.add_parser('distill', help='train a MobileNetV2 student on the cached teacher outputs')
+    p.add_argument('--teacher', default='model_trained_101class.hdf5')
+    p.add_argument('--student', default=STUDENT_MODEL)
+    p.add_argument('--teacher-dir', default='food101/teacher', help='cache of the teacher log-probabilities')
+    p.add_argument('--epochs', type=int, default=10)
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--lr', type=float, default=0.001)
+    p.add_argument('--alpha', type=float, default=0.1, help='weight of the true-label cross-entropy')
+    p.add_argument('--temperature', type=float, default=4.)
+    p.add_argument('--fast', action='store_true', help='bfloat16 mixed precision and XLA')
+    p.add_argument('--compare-only', action='store_true', help='only compare an already trained student')
+    p.add_argument('--max-images', type=int, default=2000, help='test images for the accuracy comparison')
+
+    p = commands.add_parser('serve', help='run the HTTP inference server')
+    p.add_argument('--model', default='model_trained_101class.hdf5')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8080)
+    p.add_argument('--max-batch-size', type=int, default=32)
+    p.add_argument('--max-wait-ms', type=float, default=5)
+    p.add_argument('--top-k', type=int, default=5)
+    p.add_argument('--reject', action='store_true', help='answer NO-CLASS below the calibrated threshold')
+
+    p = commands.add_parser('export-tflite', help='export an INT8 TFLite model')
+    p.add_argument('--model', default='model_trained_101class.hdf5')
+    p.add_argument('--out', default='model_int8_101class.tflite')
+    p.add_argument('--calibration-samples', type=int, default=500)
+
+    p = commands.add_parser('benchmark', help='run the benchmark suite on a synthetic dataset')
+    p.add_argument('--out', default=None, help='results JSON, bench/<commit>.json by default')
+    p.add_argument('--root', default=None, help='working folder for the synthetic dataset')
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results JSON files')
+    p.add_argument('--startup', action='store_true', help='only import and CLI startup time')
+    p.add_argument('--training-modes', action='store_true', help='only float32 against fast mode images/sec')
+    p.add_argument('--steps', type=int, default=30)
+    p.add_argument('--repeats', type=int, default=5)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.command == 'prepare':
+        prepare_data(args.filepath, args.src, args.dest, args.mode, args.workers, args.verify, args.repair)
+    elif args.command == 'cache':
+        build_dataset_cache(args.cache_dir, workers=args.workers)
+    elif args.command == 'train':
+        if args.check_resume:
+            check_resume()
+        elif args.workers > 1:
+            launch_local_workers(args.workers, per_worker_batch_size=args.batch_size, cache_dir=args.cache_dir,
+                                 fast=args.fast)
+        elif args.curriculum:
+            curriculum_training(parse_curriculum(args.curriculum), batch_size=args.batch_size, fast=args.fast)
+        elif args.resumable:
+            resumable_training(args.checkpoint_dir, args.save_every, batch_size=args.batch_size, fast=args.fast,
+                               profile_log=args.profile_log, stall_threshold=args.stall_threshold)
+        else:
+            training(batch_size=args.batch_size, cache_dir=args.cache_dir, fast=args.fast,
+                     profile_log=args.profile_log, stall_threshold=args.stall_threshold)
+    elif args.command == 'predict':
+        if args.tflite:
+            model = TFLitePredictor(args.tflite, args.threads, args.batch_size)
+        else:
+            from tensorflow.keras.models import load_model
+            model = load_model(args.model, compile=False)
+        calibration = load_calibration(args.model) if args.reject else None
+        for path, labels, scores in iter_predict_batches(model, args.images, args.batch_size, args.top_k,
+                                                         tta_views=args.tta, calibration=calibration):
+            print(path, ' '.join('%s:%.3f' % (label, score) for label, score in zip(labels, scores)))
+    elif args.command == 'calibrate':
+        calibrate(args.model, args.data_dir, args.max_images, args.target_recall)
+    elif args.command == 'tta-report':
+        tta_report(args.model, tuple(args.views), args.batch_size, args.max_images)
+    elif args.command == 'evaluate':
+        if args.merge:
+            merge_evaluations(args.out_dir)
+        elif args.workers > 1:
+            evaluate_parallel(args.workers, args.out_dir, model_path=args.model, data_dir=args.data_dir,
+                              batch_size=args.batch_size, tta_views=args.tta)
+        else:
+            evaluate(args.model, args.data_dir, args.out_dir, args.batch_size, args.num_shards, args.shard,
+                     tta_views=args.tta)
+    elif args.command == 'embed':
+        extract_embeddings(args.model, args.out_dir)
+        build_ivf_index(os.path.join(args.out_dir, 'train_embeddings.npy'), os.path.join(args.out_dir, 'train_index'),
+                        args.lists)
+    elif args.command == 'similar':
+        for image, matches in find_similar(args.images, args.model, os.path.join(args.out_dir, 'train_index'),
+                                           os.path.join(args.out_dir, 'train_paths.txt'), args.top_k, args.nprobe):
+            print(image, ' '.join('%s:%.3f' % match for match in matches))
+    elif args.command == 'duplicates':
+        find_duplicates(args.out_dir, args.threshold, args.nprobe)
+    elif args.command == 'distill':
+        if not args.compare_only:
+            distillation_training(args.teacher, args.student, args.teacher_dir, epochs=args.epochs,
+                                  batch_size=args.batch_size, lr=args.lr, alpha=args.alpha,
+                                  temperature=args.temperature, fast=args.fast)
+        compare_student(args.teacher, args.student, args.max_images)
+    elif args.command == 'serve':
+        serve(args.model, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.top_k, args.reject)
+    elif args.command == 'export-tflite':
+        export_tflite_int8(args.model, args.out, args.calibration_samples)
+    elif args.command == 'benchmark':
+        if args.compare:
+            compare_benchmarks(*args.compare)
+        elif args.startup or args.training_modes:
+            if args.startup:
+                measure_startup(args.repeats)
+            if args.training_modes:
+                benchmark_training_modes(args.steps)
+        else:
+            run_benchmarks(args.out, args.root, args.batch_size)
 """
 * **Yes### The model got them all right##**
 
@@ -479,3 +2861,7 @@ predict_class(model_best, images, True)
 * **[Twitter](https://twitter.com/avinashso13)**
 * **[Linkedin](https://www.linkedin.com/in/avinash-kappa)**
 """
+
+
+if __name__ == '__main__':
+    main()